@@ -0,0 +1,177 @@
+"""
+Микро-бенчмарк поиска адреса в листе МКД: старый линейный проход
+с re.sub на каждой строке против хэш-индекса MKDAddressIndex,
+и нечеткий поиск по триграммам на большом списке.
+
+Запуск: python benchmarks/bench_mkd_lookup.py [число_адресов] [число_запросов] [адресов_для_нечеткого]
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import logging
+
+# Модуль бота проверяет переменные окружения при импорте
+for _name, _value in {
+    'BOT_TOKEN': '0:bench', 'API_ID': '1', 'API_HASH': 'bench',
+    'SPREADSHEET_ID': 'bench', 'SHEET_NAME': 'bench', 'CHAT_IDS': '0',
+    'DRIVE_ROOT_FOLDER_ID': 'bench', 'SERVICE_ACCOUNT_JSON': '{}'
+}.items():
+    os.environ.setdefault(_name, _value)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import telegram_monitor as bot  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+STREETS = ["Профсоюзная", "Ленинский", "Академика Анохина", "Миклухо-Маклая", "Островитянова",
+           "Обручева", "Вернадского", "Удальцова", "Кравченко", "Новаторов", "Гарибальди"]
+DISTRICTS = ["ЮЗАО", "ЗАО", "ТРАО", "НМАО"]
+
+
+def legacy_clean(address):
+    """clean_address_for_mkd до оптимизации (re.sub с компиляцией по строке шаблона)"""
+    patterns_to_remove = [
+        r',\s*\d+\s*п\.?\s*', r',\s*\d+\s*этаж\s*', r',\s*подв\.?\s*', r',\s*эт\.?\s*',
+        r',\s*подъезд\s*', r',\s*пом\.?\s*', r',\s*стр\.?\s*\d*\s*', r',\s*лит\.?\s*[А-Я]\s*',
+    ]
+    cleaned = address
+    for pattern in patterns_to_remove:
+        cleaned = re.sub(pattern, ',', cleaned)
+    cleaned = re.sub(r',\s*,', ',', cleaned)
+    cleaned = re.sub(r'\s*,\s*', ', ', cleaned)
+    cleaned = re.sub(r',\s*$', '', cleaned)
+    cleaned = cleaned.strip()
+    cleaned = re.sub(r',\s*ос\.', ', пос.', cleaned)
+    cleaned = re.sub(r'^\s*ос\.', 'пос.', cleaned)
+    cleaned = re.sub(r'\(\s*', '(', cleaned)
+    cleaned = re.sub(r'\s*\)', ')', cleaned)
+    return cleaned.rstrip(' ,')
+
+
+def legacy_find(address, addresses_with_rows):
+    """check_and_mark_address_in_mkd до оптимизации (без записи статуса)"""
+    cleaned_address = legacy_clean(address)
+    clean_addr = re.sub(r'\s+', ' ', cleaned_address.strip().lower())
+    clean_addr = re.sub(r'\s*,\s*', ',', clean_addr)
+    for item in addresses_with_rows:
+        if item['status'] == 'выполнено':
+            continue
+        clean_mkd = re.sub(r'\s+', ' ', item['address'].lower())
+        clean_mkd = re.sub(r'\s*,\s*', ',', clean_mkd)
+        if clean_addr == clean_mkd or clean_addr.replace(',', '') == clean_mkd.replace(',', ''):
+            return item
+    return None
+
+
+def indexed_find(address, index):
+    item, _ = index.find(bot.clean_address_for_mkd(address))
+    return item
+
+
+def make_addresses(count, rnd, street_variants=1):
+    addresses = []
+    for row in range(2, count + 2):
+        street = rnd.choice(STREETS)
+        if street_variants > 1:
+            # Много улиц с повторяющимися номерами домов, как в реальном списке
+            street += f" {rnd.randint(1, street_variants)}-я"
+            house = f"{rnd.randint(1, 150)} корп. {rnd.randint(1, 5)}"
+        else:
+            house = f"{row // 7 + 1} корп. {row % 7 + 1}"
+        address = f"Москва, {rnd.choice(DISTRICTS)}, {street} ул., {house}"
+        status = 'выполнено' if rnd.random() < 0.1 else ''
+        addresses.append({'row': row, 'address': address, 'status': status})
+    return addresses
+
+
+def make_queries(addresses, count, rnd):
+    queries = []
+    for i in range(count):
+        if i % 2 == 0:
+            # Адрес из списка с подъездом и этажом, как пишут в чатах
+            queries.append(f"{rnd.choice(addresses)['address']}, {rnd.randint(1, 9)} п., {rnd.randint(1, 20)} этаж")
+        else:
+            queries.append(f"Москва, ЮЗАО, Несуществующая ул., {rnd.randint(1, 999)}")
+    return queries
+
+
+def make_fuzzy_queries(addresses, count, rnd):
+    """Адреса из списка, записанные по-другому: "улица" вместо "ул.", "к." вместо "корп.", пояснения в скобках"""
+    queries = []
+    for _ in range(count):
+        item = rnd.choice(addresses)
+        variant = item['address'].replace(' ул.,', ' улица,').replace('корп. ', rnd.choice(['к. ', 'корпус ', 'к']))
+        if rnd.random() < 0.5:
+            variant += ' (вход со двора)'
+        queries.append((variant, item))
+    return queries
+
+
+def bench_fuzzy(address_count, query_count, rnd):
+    addresses = make_addresses(address_count, rnd, street_variants=50)
+    queries = make_fuzzy_queries([item for item in addresses if item['status'] != 'выполнено'], query_count, rnd)
+
+    started = time.perf_counter()
+    index = bot.MKDAddressIndex(addresses)
+    build_time = time.perf_counter() - started
+
+    found = correct = 0
+    started = time.perf_counter()
+    for query, expected in queries:
+        cleaned = bot.clean_address_for_mkd(query)
+        item, _ = index.find(cleaned)
+        if item is None:
+            item, _ = index.find_fuzzy(cleaned)
+        if item is not None:
+            found += 1
+            correct += item['address'] == expected['address']
+    lookup_time = time.perf_counter() - started
+
+    print(f"\nНечеткий поиск: адресов МКД {address_count}, запросов {query_count}, порог {bot.MKD_FUZZY_THRESHOLD}")
+    print(f"Построение индекса:   {build_time * 1000:10.1f} мс")
+    print(f"Поиск:                {lookup_time / query_count * 1000:10.3f} мс на запрос")
+    print(f"Найдено:              {found} (верно {correct})")
+
+
+def measure(func, queries, *args):
+    results = []
+    started = time.perf_counter()
+    for query in queries:
+        results.append(func(query, *args))
+    return time.perf_counter() - started, results
+
+
+def main():
+    address_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    query_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rnd = random.Random(42)
+
+    addresses = make_addresses(address_count, rnd)
+    queries = make_queries(addresses, query_count, rnd)
+
+    started = time.perf_counter()
+    index = bot.MKDAddressIndex(addresses)
+    build_time = time.perf_counter() - started
+
+    legacy_time, legacy_results = measure(legacy_find, queries, addresses)
+    indexed_time, indexed_results = measure(indexed_find, queries, index)
+
+    mismatches = sum(1 for a, b in zip(legacy_results, indexed_results) if a is not b)
+    hits = sum(1 for item in indexed_results if item is not None)
+
+    print(f"Адресов МКД: {address_count}, запросов: {query_count} (найдено {hits})")
+    print(f"Построение индекса:   {build_time * 1000:10.1f} мс")
+    print(f"Линейный проход:      {legacy_time / query_count * 1000:10.3f} мс на запрос")
+    print(f"Хэш-индекс:           {indexed_time / query_count * 1000:10.3f} мс на запрос")
+    print(f"Ускорение:            {legacy_time / max(indexed_time, 1e-9):10.0f}x")
+    print(f"Расхождений:          {mismatches}")
+
+    fuzzy_count = int(sys.argv[3]) if len(sys.argv) > 3 else 100000
+    bench_fuzzy(fuzzy_count, query_count, rnd)
+
+
+if __name__ == '__main__':
+    main()
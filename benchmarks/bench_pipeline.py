@@ -0,0 +1,617 @@
+"""
+Сквозной бенчмарк обработки заявок без сети: message_handler получает
+синтетические текстовые и фото-сообщения, а Google Sheets v4, Drive v3
+и Bot API имитируются локальным aiohttp-сервером (с задержкой и ошибками квоты).
+
+Для каждого сочетания размера основного листа и листа МКД сценарий запускается
+в отдельном процессе и печатает: время старта, пропускную способность,
+p50/p95/p99 задержки (от события до подтверждения пользователю)
+и число вызовов API на заявку.
+
+С --processes N сценарий проверяет многопроцессный режим бота на одной машине:
+процесс сценария работает процессом записи (unix-сокет), а заявки из --chats чатов
+обрабатывают N процессов-воркеров, чаты делятся по chat_id % N.
+
+Запуск: python benchmarks/bench_pipeline.py --sheet-rows 1000,10000,100000 --mkd-rows 1000,10000
+        python benchmarks/bench_pipeline.py --tickets 500 --latency-ms 80 --error-rate 0.02
+        python benchmarks/bench_pipeline.py --sheet-rows 10000 --processes 4 --chats 8
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import types
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+
+from aiohttp import web
+
+SPREADSHEET_ID = 'bench-spreadsheet'
+SHEET_NAME = 'Заявки'
+MKD_SHEET_NAME = 'Обследование МКД'
+BOT_TOKEN = '0:bench'
+CHAT_ID = -1001000000001
+
+STREETS = ["Профсоюзная", "Ленинский", "Академика Анохина", "Миклухо-Маклая", "Островитянова",
+           "Обручева", "Вернадского", "Удальцова", "Кравченко", "Новаторов", "Гарибальди"]
+DISTRICTS = ["ЮЗАО", "ЗАО", "ТРАО", "НМАО"]
+
+
+# ============ ИМИТАЦИЯ GOOGLE API И BOT API ============
+def _column_index(letters):
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - 64
+    return index
+
+
+def _parse_range(a1):
+    """"'Лист'!G10:I" -> (лист, первый столбец, первая строка, последний столбец, последняя строка или None)"""
+    name, _, cells = a1.rpartition('!')
+    name = name.strip("'")
+    match = re.match(r'([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$', cells)
+    col1, row1, col2, row2 = match.groups()
+    return name, _column_index(col1), int(row1 or 1), _column_index(col2 or col1), int(row2) if row2 else None
+
+
+class FakeGoogleServer:
+    """
+    Один aiohttp-сервер в отдельном потоке: Sheets v4, Drive v3 (multipart и resumable
+    загрузки) и Bot API sendMessage. Считает вызовы по методам, добавляет задержку
+    и с заданной вероятностью отвечает 429.
+    """
+
+    def __init__(self, sheets, latency_ms=0, error_rate=0.0, seed=1):
+        self.sheets = sheets              # имя листа -> список строк
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.injected_errors = Counter()
+        self.confirmations = {}           # TT -> время получения подтверждения
+        self.uploads = {}
+        self.folders = {}
+        self.upload_metadata = {}
+        self.photos = {}  # appProperties.sha256 -> id файла (поиск после неоднозначной ошибки загрузки)
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.port = None
+        self.loop = None
+
+    def start(self):
+        started = threading.Event()
+        threading.Thread(target=self._run, args=(started,), daemon=True).start()
+        started.wait()
+        return self
+
+    def _run(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route('*', '/{tail:.*}', self.dispatch)
+        runner = web.AppRunner(app, access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def _new_id(self, prefix):
+        with self.lock:
+            self.next_id += 1
+            return f"{prefix}{self.next_id}"
+
+    async def dispatch(self, request):
+        path = request.path
+        if path.startswith(f'/bot{BOT_TOKEN}/'):
+            return await self.bot_api(request, path.rsplit('/', 1)[-1])
+        if path.startswith('/v4/spreadsheets/'):
+            api, handler = 'sheets', self.sheets_api
+        elif path.startswith('/drive/v3/') or path.startswith('/upload/drive/v3/'):
+            api, handler = 'drive', self.drive_api
+        else:
+            return web.json_response({'error': {'code': 404, 'message': path}}, status=404)
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            # Тело дочитывается: иначе keep-alive соединение httplib2 ломается
+            # и следующий запрос этого потока ждет полный таймаут
+            await request.read()
+            self.injected_errors[api] += 1
+            return web.json_response(
+                {'error': {'code': 429, 'message': 'Quota exceeded', 'status': 'RESOURCE_EXHAUSTED'}},
+                status=429
+            )
+        return await handler(request, path)
+
+    # --- Sheets v4 ---
+    def _read(self, a1):
+        name, col1, row1, col2, row2 = _parse_range(a1)
+        rows = self.sheets.get(name, [])
+        values = []
+        for row in rows[row1 - 1:row2 if row2 else len(rows)]:
+            cells = [str(cell) for cell in row[col1 - 1:col2]]
+            while cells and cells[-1] == '':
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return {'range': a1, 'majorDimension': 'ROWS', 'values': values}
+
+    def _write(self, a1, values):
+        name, col1, row1, _, _ = _parse_range(a1)
+        rows = self.sheets.setdefault(name, [])
+        for offset, new_row in enumerate(values):
+            index = row1 - 1 + offset
+            while len(rows) <= index:
+                rows.append([])
+            row = rows[index]
+            while len(row) < col1 - 1 + len(new_row):
+                row.append('')
+            row[col1 - 1:col1 - 1 + len(new_row)] = new_row
+
+    async def sheets_api(self, request, path):
+        rest = path[len(f'/v4/spreadsheets/{SPREADSHEET_ID}'):]
+        body = await request.json() if request.can_read_body else {}
+
+        if rest == '' and request.method == 'GET':
+            self.calls['sheets.spreadsheets.get'] += 1
+            return web.json_response({'sheets': [
+                {'properties': {'title': title, 'sheetId': sheet_id}}
+                for sheet_id, title in enumerate(self.sheets)
+            ]})
+        if rest == ':batchUpdate':
+            self.calls['sheets.spreadsheets.batchUpdate'] += 1
+            return web.json_response({'replies': [{} for _ in body.get('requests', [])]})
+        if rest == '/values:batchGet':
+            self.calls['sheets.values.batchGet'] += 1
+            ranges = request.rel_url.query.getall('ranges', [])
+            return web.json_response({'valueRanges': [self._read(a1) for a1 in ranges]})
+        if rest == '/values:batchUpdate':
+            self.calls['sheets.values.batchUpdate'] += 1
+            for item in body.get('data', []):
+                self._write(item['range'], item['values'])
+            return web.json_response({'totalUpdatedRows': len(body.get('data', []))})
+        if rest.startswith('/values/') and rest.endswith(':append'):
+            self.calls['sheets.values.append'] += 1
+            name = _parse_range(rest[len('/values/'):-len(':append')])[0]
+            rows = self.sheets.setdefault(name, [])
+            first_row = len(rows) + 1
+            self._write(f"'{name}'!A{first_row}", body['values'])
+            last_row = first_row + len(body['values']) - 1
+            return web.json_response({'updates': {
+                'updatedRange': f"'{name}'!A{first_row}:S{last_row}",
+                'updatedRows': len(body['values'])
+            }})
+        if rest.startswith('/values/'):
+            a1 = rest[len('/values/'):]
+            if request.method == 'PUT':
+                self.calls['sheets.values.update'] += 1
+                self._write(a1, body['values'])
+                return web.json_response({'updatedRange': a1})
+            self.calls['sheets.values.get'] += 1
+            return web.json_response(self._read(a1))
+        return web.json_response({'error': {'code': 400, 'message': rest}}, status=400)
+
+    # --- Drive v3 ---
+    @staticmethod
+    def _file(file_id):
+        return {'id': file_id, 'webViewLink': f"https://drive.google.com/file/d/{file_id}/view"}
+
+    def _file_response(self, file_id):
+        return web.json_response(self._file(file_id))
+
+    def _create_file(self, metadata):
+        file_id = self._new_id('file')
+        photo_hash = (metadata or {}).get('appProperties', {}).get('sha256')
+        if photo_hash:
+            self.photos[photo_hash] = file_id
+        return self._file_response(file_id)
+
+    @staticmethod
+    def _multipart_metadata(body):
+        """JSON-метаданные из первой части multipart-загрузки"""
+        match = re.search(rb'\{.*?\}\s*\r?\n--', body, re.S)
+        return json.loads(match.group(0).rsplit(b'--', 1)[0]) if match else {}
+
+    async def drive_api(self, request, path):
+        query = request.rel_url.query
+        if path == '/drive/v3/files' and request.method == 'GET':
+            self.calls['drive.files.list'] += 1
+            q = query.get('q', '')
+            by_hash = re.search(r"key='sha256' and value='([^']+)'", q)
+            if by_hash:
+                file_id = self.photos.get(by_hash.group(1))
+                return web.json_response({'files': [self._file(file_id)] if file_id else []})
+            name = re.search(r"name='([^']+)'", q).group(1)
+            files = [{'id': self.folders[name], 'name': name}] if name in self.folders else []
+            return web.json_response({'files': files})
+        if path == '/drive/v3/files' and request.method == 'POST':
+            self.calls['drive.files.create'] += 1
+            body = await request.json()
+            folder_id = self._new_id('folder')
+            self.folders[body['name']] = folder_id
+            return web.json_response({'id': folder_id})
+        if path.startswith('/drive/v3/files/') and path.endswith('/permissions'):
+            self.calls['drive.permissions.create'] += 1
+            return web.json_response({'id': 'anyoneWithLink', 'type': 'anyone', 'role': 'reader'})
+
+        if path == '/upload/drive/v3/files':
+            upload_type = query.get('uploadType')
+            if upload_type == 'multipart':
+                self.calls['drive.files.create(upload)'] += 1
+                return self._create_file(self._multipart_metadata(await request.read()))
+            if upload_type == 'resumable' and request.method == 'POST':
+                self.calls['drive.files.create(upload)'] += 1
+                upload_id = self._new_id('upload')
+                self.uploads[upload_id] = 0
+                self.upload_metadata[upload_id] = await request.json()
+                location = f"{self.url}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+                return web.Response(status=200, headers={'Location': location})
+            if upload_type == 'resumable' and request.method == 'PUT':
+                self.calls['drive.upload.chunk'] += 1
+                upload_id = query['upload_id']
+                chunk = await request.read()
+                self.uploads[upload_id] += len(chunk)
+                match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', request.headers.get('Content-Range', ''))
+                if match and match.group(3) != '*' and int(match.group(2)) + 1 < int(match.group(3)):
+                    return web.Response(status=308, headers={'Range': f"bytes=0-{int(match.group(2))}"})
+                return self._create_file(self.upload_metadata.pop(upload_id, None))
+        return web.json_response({'error': {'code': 400, 'message': path}}, status=400)
+
+    # --- Bot API ---
+    async def bot_api(self, request, method):
+        self.calls[f'telegram.{method}'] += 1
+        payload = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            self.injected_errors['telegram'] += 1
+            return web.json_response(
+                {'ok': False, 'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 1}},
+                status=429
+            )
+        match = re.search(r'TT: (\S+)', payload.get('text', ''))
+        if match:
+            self.confirmations[match.group(1)] = time.perf_counter()
+        return web.json_response({'ok': True, 'result': {'message_id': 1}})
+
+
+# ============ СИНТЕТИЧЕСКИЕ ДАННЫЕ ============
+def make_address(rnd):
+    return (f"Москва, {rnd.choice(DISTRICTS)}, {rnd.choice(STREETS)} ул., "
+            f"{rnd.randint(1, 200)} корп. {rnd.randint(1, 9)}")
+
+
+def make_sheets(sheet_rows, mkd_rows, rnd):
+    main_rows = [[chr(ord('A') + i) for i in range(19)]]
+    for i in range(sheet_rows):
+        row = [''] * 19
+        row[6] = f"OLD-{i}"
+        row[8] = make_address(rnd)
+        row[13] = str(CHAT_ID)
+        row[14] = str(i + 1)
+        main_rows.append(row)
+    mkd = [['№', '', '', 'Адрес', '', '', '', '', '', '', 'Статус']]
+    for _ in range(mkd_rows):
+        row = [''] * 11
+        row[3] = make_address(rnd)
+        mkd.append(row)
+    return {SHEET_NAME: main_rows, MKD_SHEET_NAME: mkd}
+
+
+class BenchMessage:
+    """Минимум интерфейса Telethon Message, который использует бот"""
+
+    def __init__(self, message_id, text, photo_bytes=None):
+        self.id = message_id
+        self.text = text
+        self.message = text
+        self.photo = object() if photo_bytes is not None else None
+        self.grouped_id = None
+        self.date = None
+        self._photo_bytes = photo_bytes
+        self.file = types.SimpleNamespace(size=len(photo_bytes) if photo_bytes is not None else None)
+
+    async def download_media(self, file=None):
+        file.write(self._photo_bytes)
+        return file
+
+
+class BenchEvent:
+    def __init__(self, message, user_id, chat_id=CHAT_ID):
+        self.chat_id = chat_id
+        self.message = message
+        self._sender = types.SimpleNamespace(id=user_id, first_name='Бенчмарк', last_name=None, username=None)
+
+    async def get_sender(self):
+        return self._sender
+
+    async def get_chat(self):
+        return types.SimpleNamespace(id=self.chat_id, title='Бенчмарк')
+
+
+def make_events(args, sheets, rnd):
+    existing = sheets[SHEET_NAME][1:]
+    mkd = sheets[MKD_SHEET_NAME][1:]
+    photo = bytes(rnd.getrandbits(8) for _ in range(args.photo_kb * 1024))
+    events = []
+    for i in range(args.tickets):
+        roll = rnd.random()
+        if existing and roll < args.duplicate_ratio:
+            old = rnd.choice(existing)
+            tt_suffix, address = old[6], old[8]  # повтор уже записанной заявки
+        elif mkd and roll < args.duplicate_ratio + args.mkd_ratio:
+            tt_suffix, address = f"MKD{i}", rnd.choice(mkd)[3] + f", {rnd.randint(1, 9)} п."
+        else:
+            tt_suffix, address = f"NEW{i}", make_address(rnd)
+        tt = f"BENCH-{i}-{tt_suffix}"
+        text = f"{tt}\n{address}"
+        # Фото у каждой заявки свое: одинаковые бот загрузил бы только один раз
+        unique_photo = photo[:-8] + i.to_bytes(8, 'big')
+        message = BenchMessage(100000 + i, text, unique_photo if rnd.random() < args.photo_ratio else None)
+        events.append((tt, BenchEvent(message, user_id=500000 + i, chat_id=chat_ids(args)[i % args.chats])))
+    return events
+
+
+def chat_ids(args):
+    return [CHAT_ID - i for i in range(args.chats)]
+
+
+def percentile(values, share):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+# ============ ОДИН СЦЕНАРИЙ (в отдельном процессе) ============
+def import_bot(args, server_url, state_db, **environ):
+    # Модуль бота читает настройки при импорте: адреса и идентификаторы всегда
+    # указывают на имитацию, а лимиты квот и Bot API подняты, чтобы мерить сам
+    # конвейер (их можно вернуть переменными окружения)
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN, 'API_ID': '1', 'API_HASH': 'bench',
+        'SPREADSHEET_ID': SPREADSHEET_ID, 'SHEET_NAME': SHEET_NAME,
+        'CHAT_IDS': ','.join(map(str, chat_ids(args))),
+        'DRIVE_ROOT_FOLDER_ID': 'bench-root', 'SERVICE_ACCOUNT_JSON': '{}',
+        'GOOGLE_API_ROOT_URL': server_url, 'TELEGRAM_API_URL': server_url,
+        'STATE_DB_PATH': state_db, **environ,
+    })
+    for name, value in {
+        'SHEETS_REQUESTS_PER_MINUTE': '60000', 'DRIVE_REQUESTS_PER_MINUTE': '60000',
+        'BOT_API_GLOBAL_RATE': '1000',
+    }.items():
+        os.environ.setdefault(name, value)
+
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    import telegram_monitor as bot
+    from google.oauth2.credentials import Credentials
+
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.GOOGLE_RETRY_BASE_DELAY = 0.2
+    bot.google_credentials = Credentials(token='bench')  # имитация не проверяет токен
+    return bot
+
+
+async def feed_events(bot, events, started, interval):
+    """Передает события в message_handler с заданным темпом, возвращает TT -> время отправки"""
+    sent_at = {}
+    for i, tt, event in events:
+        if interval:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent_at[tt] = time.perf_counter()
+        await bot.message_handler(event)
+    return sent_at
+
+
+async def start_worker_processes(args, server, state_dir):
+    """Запускает воркеры (--worker-shard) и ждет, пока каждый подключится к процессу записи"""
+    workers = []
+    for shard in range(args.processes):
+        command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                   '--worker-shard', str(shard), '--server-url', server.url, '--state-dir', state_dir]
+        workers.append(await asyncio.create_subprocess_exec(
+            *command, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        ))
+    for worker in workers:
+        await read_worker_line(worker)
+    return workers
+
+
+async def read_worker_line(worker):
+    """Следующая строка протокола воркера (строки лога бота пропускаются)"""
+    while True:
+        line = await worker.stdout.readline()
+        if not line:
+            raise RuntimeError(f"воркер {worker.pid} завершился (код {await worker.wait()})")
+        if line.startswith(b'BENCH '):
+            return line[len(b'BENCH '):].decode().strip()
+
+
+async def run_worker(args):
+    """Воркер многопроцессного сценария: свои чаты и очередь, запись - через процесс записи"""
+    rnd = random.Random(args.seed)
+    events = make_events(args, make_sheets(args.sheet_rows, args.mkd_rows, rnd), rnd)
+    bot = import_bot(
+        args, args.server_url, os.path.join(args.state_dir, f'worker{args.worker_shard}.db'),
+        BOT_ROLE='worker', BOT_PROCESSES=str(args.processes), BOT_SHARD=str(args.worker_shard),
+        BOT_PROCESS_NAME=f'bench-worker{args.worker_shard}',
+        WRITER_SOCKET=os.path.join(args.state_dir, 'writer.sock'),
+    )
+    bot.writer_client = bot.WriterClient(bot.WRITER_SOCKET)
+    await bot.writer_client.start()
+    await bot.writer_client.wait_ready()
+    await bot.telegram_sender.start()
+    bot.ingest_queue.open()
+    await bot.run_blocking(bot.init_google_clients)
+    bot.start_ingest_workers()
+    mine = [(i, tt, event) for i, (tt, event) in enumerate(events) if event.chat_id in bot.CHAT_IDS]
+
+    loop = asyncio.get_running_loop()
+    print("BENCH ready", flush=True)
+    # Общий момент старта от сценария: perf_counter в Linux - общие для процессов CLOCK_MONOTONIC
+    started = float((await loop.run_in_executor(None, sys.stdin.readline)).split()[1])
+    sent_at = await feed_events(bot, mine, started, 1 / args.rate if args.rate else 0)
+    print(f"BENCH {json.dumps(sent_at)}", flush=True)
+    # Работаем, пока сценарий не закроет stdin
+    await loop.run_in_executor(None, sys.stdin.read)
+    await bot.telegram_sender.close()
+    await bot.writer_client.close()
+
+
+async def run_scenario(args):
+    rnd = random.Random(args.seed)
+    sheets = make_sheets(args.sheet_rows, args.mkd_rows, rnd)
+    server = FakeGoogleServer(sheets, args.latency_ms, args.error_rate, args.seed).start()
+    state_dir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    bot = import_bot(args, server.url, os.path.join(state_dir, 'bot_state.db'),
+                     WRITER_SOCKET=os.path.join(state_dir, 'writer.sock'))
+
+    started = time.perf_counter()
+    await bot.telegram_sender.start()
+    bot.ingest_queue.open()
+    await bot.run_blocking(bot.init_google_clients)
+    await bot.run_blocking(bot.add_headers_if_needed, bot.sheets_service)
+    await bot.run_blocking(bot.load_duplicate_index, bot.sheets_service)
+    await bot.run_blocking(bot.load_mkd_addresses_with_rows, bot.sheets_service)
+    bot.start_background_task(bot.mkd_status_writer.run())
+    workers = []
+    if args.processes:
+        await bot.start_writer_server()
+        workers = await start_worker_processes(args, server, state_dir)
+    else:
+        bot.start_ingest_workers()
+    startup = time.perf_counter() - started
+    startup_calls = sum(server.calls.values())
+    server.calls.clear()
+
+    events = make_events(args, sheets, rnd)
+    interval = 1 / args.rate if args.rate else 0
+    started = time.perf_counter()
+    if workers:
+        started += 0.1
+        for worker in workers:
+            worker.stdin.write(f"go {started}\n".encode())
+            await worker.stdin.drain()
+        sent_at = {}
+        for worker in workers:
+            sent_at.update(json.loads(await read_worker_line(worker)))
+    else:
+        sent_at = await feed_events(bot, [(i, tt, event) for i, (tt, event) in enumerate(events)], started, interval)
+
+    deadline = time.perf_counter() + args.timeout
+    while len(server.confirmations) < len(events) and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    finished = max(server.confirmations.values(), default=time.perf_counter())
+    for worker in workers:
+        worker.stdin.close()
+        await worker.wait()
+    await bot.mkd_status_writer.close()
+    await bot.telegram_sender.close()
+
+    latencies = [server.confirmations[tt] - sent_at[tt] for tt in sent_at if tt in server.confirmations]
+    done = len(latencies)
+    google_calls = {name: count for name, count in server.calls.items() if not name.startswith('telegram.')}
+    telegram_calls = sum(count for name, count in server.calls.items() if name.startswith('telegram.'))
+    return {
+        'sheet_rows': args.sheet_rows,
+        'mkd_rows': args.mkd_rows,
+        'tickets': len(events),
+        'done': done,
+        'startup_s': startup,
+        'startup_calls': startup_calls,
+        'throughput': done / max(finished - started, 1e-9),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'google_calls_per_ticket': sum(google_calls.values()) / max(done, 1),
+        'telegram_calls_per_ticket': telegram_calls / max(done, 1),
+        'calls': dict(sorted(google_calls.items())),
+        'injected_errors': dict(server.injected_errors),
+    }
+
+
+# ============ ЗАПУСК НАБОРА СЦЕНАРИЕВ ============
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sheet-rows', default='1000,10000,100000', help='размеры основного листа через запятую')
+    parser.add_argument('--mkd-rows', default='1000', help='размеры листа МКД через запятую')
+    parser.add_argument('--tickets', type=int, default=300, help='заявок в сценарии')
+    parser.add_argument('--rate', type=float, default=100, help='сообщений в секунду (0 - все сразу)')
+    parser.add_argument('--photo-ratio', type=float, default=0.5, help='доля сообщений с фото')
+    parser.add_argument('--photo-kb', type=int, default=200, help='размер фото, КБ')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1, help='доля повторов уже записанных заявок')
+    parser.add_argument('--mkd-ratio', type=float, default=0.3, help='доля адресов из листа МКД')
+    parser.add_argument('--latency-ms', type=float, default=50, help='задержка ответа имитации API, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 429 от имитации API')
+    parser.add_argument('--timeout', type=float, default=300, help='сколько ждать подтверждений, с')
+    parser.add_argument('--processes', type=int, default=0, help='процессов-воркеров (0 - все в одном процессе)')
+    parser.add_argument('--chats', type=int, default=1, help='чатов, по которым распределены заявки')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    parser.add_argument('--scenario', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--worker-shard', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--server-url', help=argparse.SUPPRESS)
+    parser.add_argument('--state-dir', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def print_table(results):
+    print(f"{'лист':>8} {'МКД':>7} {'готово':>9} {'старт, с':>9} {'заяв/с':>8} "
+          f"{'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'Google/заявку':>14} {'Bot API/заявку':>15}")
+    for r in results:
+        print(f"{r['sheet_rows']:>8} {r['mkd_rows']:>7} {r['done']:>4}/{r['tickets']:<4} {r['startup_s']:>9.2f} "
+              f"{r['throughput']:>8.1f} {r['p50_ms']:>9.0f} {r['p95_ms']:>9.0f} {r['p99_ms']:>9.0f} "
+              f"{r['google_calls_per_ticket']:>14.2f} {r['telegram_calls_per_ticket']:>15.2f}")
+    for r in results:
+        calls = ', '.join(f"{name}={count}" for name, count in r['calls'].items())
+        errors = f"; ошибок 429: {r['injected_errors']}" if r['injected_errors'] else ""
+        print(f"  лист {r['sheet_rows']}, МКД {r['mkd_rows']}: {calls}{errors}")
+
+
+def main():
+    args = parse_args()
+    if args.scenario:
+        args.sheet_rows, args.mkd_rows = int(args.sheet_rows), int(args.mkd_rows)
+        if args.worker_shard is not None:
+            asyncio.run(run_worker(args))
+        else:
+            print(json.dumps(asyncio.run(run_scenario(args))))
+        return
+
+    results = []
+    for sheet_rows in [int(x) for x in args.sheet_rows.split(',')]:
+        for mkd_rows in [int(x) for x in args.mkd_rows.split(',')]:
+            # Каждый сценарий - в своем процессе: у бота глобальное состояние (кэши, очереди)
+            argv = [arg for arg in sys.argv[1:] if arg != '--json']
+            command = [sys.executable, os.path.abspath(__file__), *argv, '--scenario',
+                       '--sheet-rows', str(sheet_rows), '--mkd-rows', str(mkd_rows)]
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            print(f"лист {sheet_rows}, МКД {mkd_rows}: готово", file=sys.stderr)
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,20 +10,33 @@
 """
 
 import asyncio
+import contextlib
 import datetime
+import functools
 import os
 import io
 import sys
 import logging
+import logging.handlers
+import atexit
+import hashlib
+import hmac
+import queue
 import traceback
 import json
+import random
 import re
+import signal
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from telethon import TelegramClient, events
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+PROCESS_STARTED = time.perf_counter()
+from telethon import TelegramClient, events, types, utils
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseUpload
+import aiohttp
 from aiohttp import web
 
 # ============ ФУНКЦИИ ЛОГИРОВАНИЯ ============
@@ -36,6 +49,10 @@ def log_error(message):
 def log_warn(message):
     logging.warning(f"[WARN] {message}")
 
+def log_debug(message, *args):
+    # Аргументы подставляются только если уровень DEBUG включен
+    logging.debug(message, *args)
+
 # ============ ФУНКЦИЯ ДЛЯ МОСКОВСКОГО ВРЕМЕНИ ============
 def get_moscow_time():
     utc_time = datetime.now(timezone.utc)
@@ -56,7 +73,40 @@ log_dir = os.path.join(os.path.dirname(__file__), 'logs')
 if not os.path.exists(log_dir):
     os.makedirs(log_dir)
 
-log_filename = os.path.join(log_dir, f'bot_{get_moscow_time().strftime("%Y%m%d_%H%M%S")}.log')
+# Один файл logs/bot.log: ротация раз в сутки и при превышении LOG_MAX_BYTES,
+# хранится LOG_BACKUP_COUNT старых файлов. LOG_LEVEL=DEBUG включает подробный лог поиска МКД
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 14))
+# В многопроцессном режиме (BOT_PROCESSES) у каждого процесса свой файл и префикс в stdout
+BOT_PROCESS_NAME = os.environ.get('BOT_PROCESS_NAME', '')
+log_filename = os.path.join(log_dir, f"{BOT_PROCESS_NAME or 'bot'}.log")
+LOG_FORMAT = f'%(asctime)s - [{BOT_PROCESS_NAME}] %(message)s' if BOT_PROCESS_NAME else '%(asctime)s - %(message)s'
+
+class SizedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """Ротация по времени и по размеру; файлы одного дня получают суффиксы .001, .002, ..."""
+    
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+        self.namer = self._unique_name
+    
+    @staticmethod
+    def _unique_name(default_name):
+        # Стандартный обработчик удалил бы файл, уже повернутый по размеру в этот день
+        name, counter = default_name, 0
+        while os.path.exists(name):
+            counter += 1
+            name = f"{default_name}.{counter:03d}"
+        return name
+    
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, io.SEEK_END)
+            return self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes
+        return False
 
 class MoscowTimeFormatter(logging.Formatter):
     def formatTime(self, record, datefmt=None):
@@ -66,16 +116,29 @@ class MoscowTimeFormatter(logging.Formatter):
             return moscow_dt.strftime(datefmt)
         return moscow_dt.strftime("%Y-%m-%d %H:%M:%S")
 
-handler = logging.StreamHandler(sys.stdout)
-handler.setFormatter(MoscowTimeFormatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(MoscowTimeFormatter(LOG_FORMAT, datefmt='%Y-%m-%d %H:%M:%S'))
+
+file_handler = SizedTimedRotatingFileHandler(
+    log_filename,
+    max_bytes=LOG_MAX_BYTES,
+    when='midnight',
+    backupCount=LOG_BACKUP_COUNT,
+    encoding='utf-8'
+)
+file_handler.setFormatter(MoscowTimeFormatter(LOG_FORMAT, datefmt='%Y-%m-%d %H:%M:%S'))
 
-file_handler = logging.FileHandler(log_filename, encoding='utf-8')
-file_handler.setFormatter(MoscowTimeFormatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+# Вызовы логирования только кладут запись в очередь; форматирование, запись на диск
+# и в stdout идут в отдельном потоке QueueListener и не блокируют цикл событий
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler)
 
 logging.basicConfig(
-    level=logging.INFO,
-    handlers=[file_handler, handler]
+    level=getattr(logging, LOG_LEVEL, logging.INFO),
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # ============ ПРОВЕРКА ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ============
 required_vars = [
@@ -116,21 +179,16 @@ CHAT_IDS = [int(x.strip()) for x in CHAT_IDS_STR.split(',')]
 
 # ============ ЗАГРУЗКА CREDENTIALS ИЗ ПЕРЕМЕННОЙ ОКРУЖЕНИЯ ============
 SERVICE_ACCOUNT_JSON = os.environ.get('SERVICE_ACCOUNT_JSON')
-SERVICE_ACCOUNT_FILE = '/tmp/credentials.json'
 
 try:
     json_str = SERVICE_ACCOUNT_JSON.strip()
     if json_str.startswith('\ufeff'):
         json_str = json_str[1:]
     
+    # Ключ используется прямо из памяти (from_service_account_info), файл на диск не пишется
     json_data = json.loads(json_str)
     log_info("[OK] JSON валидный")
     
-    with open(SERVICE_ACCOUNT_FILE, 'w', encoding='utf-8') as f:
-        json.dump(json_data, f, indent=2)
-    
-    log_info(f"[OK] Файл credentials.json создан: {SERVICE_ACCOUNT_FILE}")
-    
 except json.JSONDecodeError as e:
     log_error(f"Ошибка парсинга JSON: {e}")
     sys.exit(1)
@@ -160,10 +218,341 @@ chats_cache = {}
 bot_client = None
 web_app = None
 
+# Общие клиенты Google API (создаются один раз в main)
+GOOGLE_SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+GOOGLE_HTTP_TIMEOUT = int(os.environ.get('GOOGLE_HTTP_TIMEOUT', 60))
+# Другой адрес Google API (локальные имитации Sheets/Drive, см. benchmarks/bench_pipeline.py)
+GOOGLE_API_ROOT_URL = os.environ.get('GOOGLE_API_ROOT_URL')
+google_credentials = None
+sheets_service = None
+# Тяжелые модули Google API (~0.3 с импорта) загружает _import_google_modules при первом подключении
+httplib2 = None
+service_account = None
+AuthorizedHttp = None
+build_from_document = None
+get_static_doc = None
+HttpRequest = None
+MediaIoBaseUpload = None
+drive_service = None
+google_clients_lock = threading.Lock()
+_thread_http = threading.local()
+google_client_stats = {
+    'builds': 0,              # сколько раз клиенты реально собирались
+    'builds_saved': 0,        # сборок, которые раньше делались на каждую заявку (Sheets) и каждое фото (Drive)
+    'connections_opened': 0,  # сколько HTTP-клиентов (пулов соединений) создано
+    'connections_reused': 0,  # сколько запросов ушло по уже открытым соединениям
+    'retries': 0,             # повторов после 429/5xx и сетевых ошибок
+    'throttled': 0            # запросов, которые ждали свободной квоты
+}
+google_client_stats_lock = threading.Lock()
+
+# Квоты Google API (запросов в минуту на сервисный аккаунт) и повторы при 429/5xx.
+# Приоритеты: чем меньше число, тем раньше запрос получает квоту
+GOOGLE_QUOTA_PER_MINUTE = {
+    'sheets': int(os.environ.get('SHEETS_REQUESTS_PER_MINUTE', 60)),
+    'drive': int(os.environ.get('DRIVE_REQUESTS_PER_MINUTE', 600))
+}
+GOOGLE_QUOTA_BURST = int(os.environ.get('GOOGLE_QUOTA_BURST', 10))
+GOOGLE_MAX_RETRIES = int(os.environ.get('GOOGLE_MAX_RETRIES', 6))
+GOOGLE_RETRY_BASE_DELAY = 1.0
+GOOGLE_RETRY_MAX_DELAY = 64.0
+PRIORITY_TICKET = 0       # запись заявки, фото, папка дня
+PRIORITY_BACKGROUND = 1   # отметки МКД, сверка индекса дубликатов
+PRIORITY_MAINTENANCE = 2  # обновление листа МКД, проверка заголовков
+
+# Пул потоков для блокирующих вызовов Google API,
+# чтобы они не останавливали цикл событий Telethon и веб-сервер
+GOOGLE_IO_WORKERS = int(os.environ.get('GOOGLE_IO_WORKERS', 8))
+google_executor = ThreadPoolExecutor(max_workers=GOOGLE_IO_WORKERS, thread_name_prefix='google-io')
+# Отдельный пул для локальной работы (SQLite, хэши): потоки google-io могут спать
+# в паузах лимита квоты, и запросы /tickets ждали бы их
+LOCAL_IO_WORKERS = int(os.environ.get('LOCAL_IO_WORKERS', 2))
+local_executor = ThreadPoolExecutor(max_workers=LOCAL_IO_WORKERS, thread_name_prefix='local-io')
+background_tasks = set()
+
+# Надежная очередь входящих заявок (SQLite) и воркеры, которые ее разбирают
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', os.path.join(os.path.dirname(__file__), 'data', 'bot_state.db'))
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', os.environ.get('MAX_CONCURRENT_MESSAGES', 10)))
+INGEST_MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', 8))
+INGEST_RETRY_BASE_DELAY = float(os.environ.get('INGEST_RETRY_BASE_DELAY', 5))
+INGEST_RETRY_MAX_DELAY = float(os.environ.get('INGEST_RETRY_MAX_DELAY', 600))
+INGEST_POLL_INTERVAL = 5
+INGEST_RETENTION_DAYS = int(os.environ.get('INGEST_RETENTION_DAYS', 7))
+# Фото одного альбома (grouped_id), пришедшие за это время, становятся одной заявкой
+ALBUM_GROUP_WINDOW = float(os.environ.get('ALBUM_GROUP_WINDOW', 2))
+
+# Догрузка сообщений, пришедших, пока бот был остановлен
+BACKFILL_BATCH_SIZE = 100          # message_id за один запрос
+BACKFILL_MAX_MESSAGES = int(os.environ.get('BACKFILL_MAX_MESSAGES', 2000))
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 5))
+BACKFILL_EMPTY_BATCHES = 2         # столько пустых пачек подряд после известного последнего id - конец пропуска
+HANDLED_MESSAGES_LIMIT = 10000
+handled_messages = OrderedDict()   # (chat_id, message_id), уже переданные в обработку этим процессом
+live_messages = {}  # (chat_id, message_id) -> сообщение Telethon, полученное в этом процессе
+live_message_ids = {}  # chat_id -> наибольший message_id из живых событий этого процесса
+
+# Несколько процессов (BOT_PROCESSES > 0): супервизор запускает процесс записи в лист
+# (BOT_ROLE=writer) и BOT_PROCESSES воркеров (BOT_ROLE=worker) со своими сессиями Telethon;
+# чаты делятся между воркерами по chat_id % BOT_PROCESSES. Строки, индекс дубликатов и МКД
+# есть только у процесса записи, воркеры обращаются к нему JSON-запросами через unix-сокет
+BOT_PROCESSES = int(os.environ.get('BOT_PROCESSES', 0))
+BOT_ROLE = os.environ.get('BOT_ROLE', 'supervisor' if BOT_PROCESSES > 0 else 'single')
+BOT_SHARD = int(os.environ.get('BOT_SHARD', 0))
+TELEGRAM_SESSION = os.environ.get('TELEGRAM_SESSION', 'bot_session')
+WRITER_SOCKET = os.environ.get('WRITER_SOCKET', os.path.join(os.path.dirname(__file__), 'data', 'writer.sock'))
+WRITER_TIMEOUT = float(os.environ.get('WRITER_TIMEOUT', 120))
+WRITER_STARTUP_TIMEOUT = float(os.environ.get('WRITER_STARTUP_TIMEOUT', 300))
+SUPERVISOR_RESTART_MAX_DELAY = 60
+SUPERVISOR_STOP_TIMEOUT = 30
+writer_client = None  # WriterClient в процессе воркера
+writer_tickets_in_flight = {}  # процесс записи: (chat_id, message_id) -> future с номером строки
+
+def shard_chat_ids(chat_ids, shard, shards):
+    return [chat_id for chat_id in chat_ids if chat_id % shards == shard]
+
+if BOT_ROLE == 'worker':
+    CHAT_IDS = shard_chat_ids(CHAT_IDS, BOT_SHARD, BOT_PROCESSES)
+
+# Отправка через Bot API: общая aiohttp-сессия, очередь и лимиты Telegram
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+BOT_API_WORKERS = int(os.environ.get('BOT_API_WORKERS', 4))
+BOT_API_TIMEOUT = float(os.environ.get('BOT_API_TIMEOUT', 10))
+BOT_API_GLOBAL_RATE = float(os.environ.get('BOT_API_GLOBAL_RATE', 25))        # сообщений в секунду на бота
+BOT_API_PER_CHAT_INTERVAL = float(os.environ.get('BOT_API_PER_CHAT_INTERVAL', 1))  # секунд между сообщениями в один чат
+BOT_API_MAX_RETRIES = int(os.environ.get('BOT_API_MAX_RETRIES', 5))
+
+# Отложенная пакетная запись строк в основной лист
+SHEET_BATCH_WINDOW_MS = int(os.environ.get('SHEET_BATCH_WINDOW_MS', 250))
+SHEET_BATCH_MAX_ROWS = int(os.environ.get('SHEET_BATCH_MAX_ROWS', 20))
+SHEET_FORMAT_RETRY_INTERVAL = int(os.environ.get('SHEET_FORMAT_RETRY_INTERVAL', 30))  # повтор оформления строк
+APPEND_MAX_ATTEMPTS = 3        # попыток append с проверкой листа между ними
+APPEND_VERIFY_TAIL_ROWS = 200  # сколько строк хвоста (N:O) просматривается перед повтором append
+sheet_id_cache = None
+
+# Индекс дубликатов (TT, адрес) и его сверка с хвостом листа
+DUPLICATE_RECONCILE_INTERVAL = int(os.environ.get('DUPLICATE_RECONCILE_INTERVAL', 300))
+DUPLICATE_RECONCILE_TAIL_ROWS = int(os.environ.get('DUPLICATE_RECONCILE_TAIL_ROWS', 500))
+DUPLICATE_LOAD_RETRY_MAX_DELAY = 60
+
+# Локальная копия листа заявок (A-S) для /tickets и /stats: строки бота пишутся в нее сразу,
+# хвост листа сверяется каждые TICKET_MIRROR_SYNC_INTERVAL секунд, весь лист - раз в
+# TICKET_MIRROR_FULL_SYNC_INTERVAL (ручные правки старых строк, закрытие заявок)
+TICKET_MIRROR_PATH = os.environ.get('TICKET_MIRROR_PATH', os.path.join(os.path.dirname(__file__), 'data', 'tickets.db'))
+TICKET_MIRROR_SYNC_INTERVAL = int(os.environ.get('TICKET_MIRROR_SYNC_INTERVAL', 300))
+TICKET_MIRROR_FULL_SYNC_INTERVAL = int(os.environ.get('TICKET_MIRROR_FULL_SYNC_INTERVAL', 6 * 3600))
+TICKET_MIRROR_TAIL_ROWS = int(os.environ.get('TICKET_MIRROR_TAIL_ROWS', 1000))
+TICKET_MIRROR_BATCH_SIZE = 5000  # строк за одну транзакцию при полной сверке
+# /tickets и /stats на общем порту отдают данные заявок только с этим токеном
+# (заголовок Authorization: Bearer <токен> или X-Api-Token); без токена они выключены
+TICKETS_API_TOKEN = os.environ.get('TICKETS_API_TOKEN', '')
+TICKETS_DEFAULT_LIMIT = 100
+TICKETS_MAX_LIMIT = 1000
+
+# Фото обрабатываются в памяти: общий лимит на одновременно скачанные фото
+PHOTO_MEMORY_LIMIT_MB = int(os.environ.get('PHOTO_MEMORY_LIMIT_MB', 64))
+PHOTO_DEFAULT_SIZE = 1024 * 1024  # если Telegram не сообщил размер
+PHOTO_UPLOAD_CHUNK_SIZE = 1024 * 1024
+DRIVE_CREATE_ATTEMPTS = 3  # попыток создать папку/файл с проверкой Drive между ними
+# Сколько последних загруженных фото помнить по хэшу содержимого (повтор не загружается заново)
+PHOTO_HASH_CACHE_SIZE = int(os.environ.get('PHOTO_HASH_CACHE_SIZE', 20000))
+
+# Папка дня на Drive: имя папки -> ID (ищется/создается раз в сутки)
+drive_folder_cache = {}
+drive_folder_lock = threading.Lock()
+
 # Кэш для адресов из МКД, чтобы не запрашивать каждый раз
 mkd_addresses_cache = None
 mkd_addresses_cache_time = None
 CACHE_DURATION = 3600  # Кэш на 1 час
+MKD_REFRESH_INTERVAL = int(os.environ.get('MKD_REFRESH_INTERVAL', 900))  # фоновое обновление раньше, чем истечет кэш
+mkd_address_index = None
+mkd_locally_marked = set()  # строки, отмеченные ботом и еще не подтвержденные листом
+mkd_refresh_lock = threading.Lock()
+mkd_match_lock = threading.Lock()
+
+# Пакетная запись отметок "выполнено" в лист МКД
+MKD_STATUS_FLUSH_INTERVAL = float(os.environ.get('MKD_STATUS_FLUSH_INTERVAL', 5))
+MKD_STATUS_BATCH_SIZE = int(os.environ.get('MKD_STATUS_BATCH_SIZE', 50))
+MKD_STATUS_RETRY_MAX_DELAY = float(os.environ.get('MKD_STATUS_RETRY_MAX_DELAY', 300))
+
+# Регулярные выражения очистки и нормализации адресов (компилируются один раз)
+# Паттерны для удаления информации о подъездах и этажах, НЕ трогаем корпуса
+MKD_CLEANUP_PATTERNS = [re.compile(pattern) for pattern in (
+    r',\s*\d+\s*п\.?\s*',           # удаляет ", 1 п." или ", 1п."
+    r',\s*\d+\s*этаж\s*',           # удаляет ", 1 этаж"
+    r',\s*подв\.?\s*',              # удаляет ", подв."
+    r',\s*эт\.?\s*',                # удаляет ", эт."
+    r',\s*подъезд\s*',              # удаляет ", подъезд"
+    r',\s*пом\.?\s*',               # удаляет ", пом."
+    r',\s*стр\.?\s*\d*\s*',         # удаляет ", стр."
+    r',\s*лит\.?\s*[А-Я]\s*',       # удаляет ", лит. А"
+)]
+MKD_RE_DOUBLE_COMMA = re.compile(r',\s*,')
+MKD_RE_COMMA_SPACES = re.compile(r'\s*,\s*')
+MKD_RE_TRAILING_COMMA = re.compile(r',\s*$')
+MKD_RE_BROKEN_POS = re.compile(r',\s*ос\.')
+MKD_RE_BROKEN_POS_START = re.compile(r'^\s*ос\.')
+MKD_RE_OPEN_PAREN = re.compile(r'\(\s*')
+MKD_RE_CLOSE_PAREN = re.compile(r'\s*\)')
+MKD_RE_SPACES = re.compile(r'\s+')
+
+# Нечеткий поиск по МКД: порог сходства (коэффициент Дайса по триграммам), 1.0 - только точное
+MKD_FUZZY_THRESHOLD = float(os.environ.get('MKD_FUZZY_THRESHOLD', 0.85))
+MKD_FUZZY_MAX_LENGTH_DIFF = 2  # опечатка, а не другая улица ("Черемушкинская" / "Новочеремушкинская")
+MKD_FUZZY_RE_PARENS = re.compile(r'\([^)]*\)')
+MKD_FUZZY_RE_ABBREVIATIONS = [
+    (re.compile(r'\bпр-т\b'), ' пр '),
+    (re.compile(r'\bпр-д\b'), ' прд '),
+    (re.compile(r'\bб-р\b'), ' бр '),
+]
+MKD_FUZZY_RE_DIGIT_LETTER = re.compile(r'(?<=\d)(?=[а-яa-z])|(?<=[а-яa-z])(?=\d)')
+MKD_FUZZY_RE_TOKENS = re.compile(r'[0-9a-zа-я]+')
+# Синонимы приводятся к одному написанию, пустая строка - слово отбрасывается
+MKD_FUZZY_TOKEN_MAP = {
+    'улица': 'ул', 'проспект': 'пр', 'просп': 'пр', 'переулок': 'пер', 'бульвар': 'бр',
+    'шоссе': 'ш', 'проезд': 'прд', 'площадь': 'пл', 'набережная': 'наб', 'наб': 'наб',
+    'корпус': 'к', 'корп': 'к', 'строение': 'с', 'стр': 'с', 'литера': '', 'лит': '', 'буква': '',
+    'поселок': 'пос', 'поселение': 'пос', 'п': 'пос', 'деревня': 'дер',
+    'дом': '', 'д': '', 'город': '', 'г': '', 'москва': '', 'россия': '',
+}
+# Обозначения корпуса и строения: одиночная буква после номера, кроме них, - литера дома ("10а")
+MKD_FUZZY_DESIGNATORS = {'к', 'с'}
+# Тип улицы и округ должны совпадать точно: "пр-д" не "пр-т", "ЗАО" не "ЮЗАО"
+MKD_FUZZY_STREET_TYPES = {'ул', 'пр', 'пер', 'бр', 'ш', 'прд', 'пл', 'наб', 'туп', 'аллея', 'мкр', 'кв', 'линия'}
+MKD_FUZZY_DISTRICTS = {'цао', 'сао', 'свао', 'вао', 'ювао', 'юао', 'юзао', 'зао', 'сзао', 'зелао', 'нао', 'тао', 'нмао', 'трао'}
+
+# ============ ВЫПОЛНЕНИЕ БЛОКИРУЮЩИХ ВЫЗОВОВ ============
+async def run_blocking(func, *args, executor=None, **kwargs):
+    """Выполняет блокирующую функцию в пуле потоков (по умолчанию - пул Google API)"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor or google_executor,
+        functools.partial(func, *args, **kwargs)
+    )
+
+def start_background_task(coro):
+    """Запускает фоновую задачу и хранит ссылку на нее до завершения"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# ============ МЕТРИКИ (Prometheus) ============
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """
+    Счетчики и гистограммы в памяти процесса, отдаются на /metrics
+    в текстовом формате Prometheus. Потокобезопасны (пишутся и из пула Google API).
+    """
+    
+    def __init__(self, buckets=METRICS_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}    # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счетчики по корзинам, сумма, количество]
+        self.help = {}
+    
+    @staticmethod
+    def _labels(labels):
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+    
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = (name, self._labels(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+    
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+    
+    def render(self, gauges=()):
+        """Текст для Prometheus; gauges - список (имя, метки, значение), снятых в момент запроса"""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in self.histograms.items())
+        
+        lines = []
+        described = set()
+        
+        def header(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self.help.get(name, (default_kind, name))
+            lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+        
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            header(name, 'histogram')
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', str(bound))])} {bucket_count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        for name, labels, value in gauges:
+            header(name, 'gauge')
+            lines.append(f"{name}{self._format_labels(self._labels(labels))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe('bot_stage_duration_seconds', 'histogram', 'Длительность стадий обработки заявки')
+metrics.describe('bot_messages_total', 'counter', 'Входящие сообщения по типу')
+metrics.describe('bot_ingest_jobs_total', 'counter', 'Результаты обработки заявок из очереди')
+metrics.describe('bot_sheet_rows_written_total', 'counter', 'Строк записано в основной лист')
+metrics.describe('bot_photo_uploads_total', 'counter', 'Фото загружено в Drive, ссылка переиспользована по хэшу или фото не загружено за все попытки (lost)')
+metrics.describe('google_api_requests_total', 'counter', 'Запросы к Google API по методу')
+metrics.describe('google_api_errors_total', 'counter', 'Ошибки Google API по методу и коду')
+metrics.describe('google_api_retries_total', 'counter', 'Повторы запросов Google API')
+metrics.describe('google_api_throttled_total', 'counter', 'Запросы Google API, ждавшие квоты')
+metrics.describe('telegram_api_requests_total', 'counter', 'Запросы к Bot API по методу и результату')
+metrics.describe('telegram_api_retries_total', 'counter', 'Повторы отправки через Bot API')
+metrics.describe('bot_ingest_queue_depth', 'gauge', 'Заявок в очереди (ожидают и в обработке)')
+metrics.describe('bot_send_queue_depth', 'gauge', 'Сообщений в очереди отправки Bot API')
+metrics.describe('bot_sheet_buffer_rows', 'gauge', 'Строк в буфере записи в лист')
+metrics.describe('bot_mkd_status_pending', 'gauge', 'Отметок МКД, ожидающих записи')
+metrics.describe('bot_sheet_format_pending', 'gauge', 'Пакетов строк, ожидающих оформления (флажки, дубликаты)')
+metrics.describe('bot_photo_memory_bytes', 'gauge', 'Объем фото в памяти')
+metrics.describe('bot_duplicate_index_rows', 'gauge', 'Строк в индексе дубликатов')
+metrics.describe('bot_mkd_cache_addresses', 'gauge', 'Адресов в кэше листа МКД')
+metrics.describe('bot_mkd_cache_age_seconds', 'gauge', 'Возраст кэша листа МКД')
+metrics.describe('bot_ticket_mirror_rows', 'gauge', 'Строк в локальной копии листа заявок')
 
 # ============ ФУНКЦИЯ ОЧИСТКИ АДРЕСА ОТ ПОДЪЕЗДОВ И ЭТАЖЕЙ ============
 def clean_address_for_mkd(address):
@@ -181,144 +570,378 @@ def clean_address_for_mkd(address):
     if not address:
         return ""
     
-    # Паттерны для удаления информации о подъездах и этажах
-    # НЕ трогаем корпуса
-    patterns_to_remove = [
-        r',\s*\d+\s*п\.?\s*',           # удаляет ", 1 п." или ", 1п."
-        r',\s*\d+\s*этаж\s*',           # удаляет ", 1 этаж"
-        r',\s*подв\.?\s*',              # удаляет ", подв."
-        r',\s*эт\.?\s*',                # удаляет ", эт."
-        r',\s*подъезд\s*',              # удаляет ", подъезд"
-        r',\s*пом\.?\s*',               # удаляет ", пом."
-        r',\s*стр\.?\s*\d*\s*',         # удаляет ", стр."
-        r',\s*лит\.?\s*[А-Я]\s*',       # удаляет ", лит. А"
-    ]
-    
     cleaned = address
-    for pattern in patterns_to_remove:
-        cleaned = re.sub(pattern, ',', cleaned)
+    for pattern in MKD_CLEANUP_PATTERNS:
+        cleaned = pattern.sub(',', cleaned)
     
     # Удаляем лишние запятые и нормализуем пробелы
-    cleaned = re.sub(r',\s*,', ',', cleaned)           # удаляем двойные запятые
-    cleaned = re.sub(r'\s*,\s*', ', ', cleaned)        # нормализуем пробелы вокруг запятых
-    cleaned = re.sub(r',\s*$', '', cleaned)            # удаляем запятую в конце
+    cleaned = MKD_RE_DOUBLE_COMMA.sub(',', cleaned)         # удаляем двойные запятые
+    cleaned = MKD_RE_COMMA_SPACES.sub(', ', cleaned)        # нормализуем пробелы вокруг запятых
+    cleaned = MKD_RE_TRAILING_COMMA.sub('', cleaned)        # удаляем запятую в конце
     cleaned = cleaned.strip()
     
     # Восстанавливаем "пос." если было повреждено
-    cleaned = re.sub(r',\s*ос\.', ', пос.', cleaned)
-    cleaned = re.sub(r'^\s*ос\.', 'пос.', cleaned)
+    cleaned = MKD_RE_BROKEN_POS.sub(', пос.', cleaned)
+    cleaned = MKD_RE_BROKEN_POS_START.sub('пос.', cleaned)
     
     # Убираем лишние пробелы внутри скобок
-    cleaned = re.sub(r'\(\s*', '(', cleaned)
-    cleaned = re.sub(r'\s*\)', ')', cleaned)
+    cleaned = MKD_RE_OPEN_PAREN.sub('(', cleaned)
+    cleaned = MKD_RE_CLOSE_PAREN.sub(')', cleaned)
     
     # Убираем лишние пробелы в конце
     cleaned = cleaned.rstrip(' ,')
     
-    log_info(f"[MKD] Очистка адреса:\n   Исходный: {address}\n   Очищенный: {cleaned}")
+    log_debug("[MKD] Очистка адреса: '%s' -> '%s'", address, cleaned)
     
     return cleaned
 
-# ============ ФУНКЦИИ РАБОТЫ С ЛИСТОМ МКД ============
-def load_mkd_addresses_with_rows(sheets):
+def normalize_mkd_address(address):
+    """Ключ для точного сравнения адресов МКД: нижний регистр, единичные пробелы, запятые без пробелов"""
+    normalized = MKD_RE_SPACES.sub(' ', address.strip().lower())
+    return MKD_RE_COMMA_SPACES.sub(',', normalized)
+
+def fuzzy_mkd_tokens(address):
     """
-    Загружает адреса из листа Обследование МКД (столбец D) с номерами строк
-    Возвращает список словарей: [{'row': номер_строки, 'address': адрес, 'status': статус}, ...]
+    Канонические токены адреса для нечеткого поиска:
+    без скобок, "улица"/"ул." -> "ул", "корпус"/"корп." -> "к", "21к1" -> "21 к 1"
+    """
+    text = address.lower().replace('ё', 'е')
+    text = MKD_FUZZY_RE_PARENS.sub(' ', text)
+    for pattern, replacement in MKD_FUZZY_RE_ABBREVIATIONS:
+        text = pattern.sub(replacement, text)
+    text = MKD_FUZZY_RE_DIGIT_LETTER.sub(' ', text)
+    tokens = []
+    for token in MKD_FUZZY_RE_TOKENS.findall(text):
+        token = MKD_FUZZY_TOKEN_MAP.get(token, token)
+        if token:
+            tokens.append(token)
+    return tokens
+
+def _fuzzy_key(address):
+    """
+    (ключ корзины, канонический адрес, название улицы). Ключ корзины - номера
+    дома/корпуса с литерой ("10а" и "10" - разные дома), тип улицы и округ:
+    они сравниваются только точно.
+    Слова сортируются, чтобы "ул. Профсоюзная" и "Профсоюзная ул." давали одинаковые триграммы.
+    """
+    tokens = fuzzy_mkd_tokens(address)
+    numbers, words = [], []
+    for i, token in enumerate(tokens):
+        is_letter = (len(token) == 1 and token.isalpha() and token not in MKD_FUZZY_DESIGNATORS
+                     and i > 0 and tokens[i - 1].isdigit())
+        if token.isdigit() or is_letter:
+            numbers.append(token)
+        else:
+            words.append(token)
+    numbers = tuple(numbers)
+    words.sort()
+    street_types = tuple(sorted({word for word in words if word in MKD_FUZZY_STREET_TYPES}))
+    districts = tuple(sorted({word for word in words if word in MKD_FUZZY_DISTRICTS}))
+    name = ' '.join(word for word in words if word not in MKD_FUZZY_STREET_TYPES and word not in MKD_FUZZY_DISTRICTS)
+    return (numbers, street_types, districts), ' '.join(words + list(numbers)), name
+
+def _trigrams(text):
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class MKDAddressIndex:
     """
-    global mkd_addresses_cache, mkd_addresses_cache_time
+    Хэш-индекс адресов МКД: нормализованный адрес (с запятыми и без) -> строки листа.
+    Ключи вычисляются один раз при загрузке, поиск - O(1) на сообщение.
     
-    current_time = datetime.now().timestamp()
-    if mkd_addresses_cache is not None and mkd_addresses_cache_time is not None:
-        if current_time - mkd_addresses_cache_time < CACHE_DURATION:
-            log_info("[MKD] Использую кэшированные адреса")
-            return mkd_addresses_cache
+    Для нечеткого поиска адреса разложены по инвертированному индексу номеров дома
+    и корпуса, типа улицы и округа: кандидатами бывают только адреса с теми же
+    числами, типом и округом, поэтому "Ленина, 13" не совпадет с "Ленина, 31",
+    "пр-д" с "пр-т", а сравнивать приходится единицы адресов.
+    Триграммы кандидатов считаются при первом обращении к их номеру дома и запоминаются.
+    """
     
-    try:
-        # Проверяем существование листа
-        spreadsheet = sheets.get(spreadsheetId=SPREADSHEET_ID).execute()
-        sheets_list = spreadsheet.get('sheets', [])
-        
-        sheet_exists = False
-        for sheet in sheets_list:
-            properties = sheet.get('properties', {})
-            if properties.get('title') == MKD_SHEET_NAME:
-                sheet_exists = True
+    def __init__(self, items):
+        self.items = items
+        self.exact = {}
+        self.without_commas = {}
+        self.fuzzy_buckets = {}  # (номера, тип улицы, округ) -> [[item, канонический адрес, название, триграммы]]
+        self.fuzzy_lock = threading.Lock()
+        for item in items:
+            key = normalize_mkd_address(item['address'])
+            self.exact.setdefault(key, []).append(item)
+            self.without_commas.setdefault(key.replace(',', ''), []).append(item)
+            bucket_key, canonical, name = _fuzzy_key(item['address'])
+            if canonical:
+                self.fuzzy_buckets.setdefault(bucket_key, []).append([item, canonical, name, None])
+    
+    def find(self, cleaned_address):
+        """
+        Первая (по номеру строки) невыполненная строка с совпадающим адресом.
+        Возвращает (item, exact) или (None, False).
+        """
+        key = normalize_mkd_address(cleaned_address)
+        best, best_exact = None, False
+        for candidates, exact in ((self.exact.get(key, ()), True),
+                                  (self.without_commas.get(key.replace(',', ''), ()), False)):
+            for item in candidates:
+                # Пропускаем уже выполненные
+                if item['status'] == 'выполнено':
+                    continue
+                if best is None or item['row'] < best['row']:
+                    best, best_exact = item, exact
                 break
+        return best, best_exact
+    
+    def find_fuzzy(self, cleaned_address, threshold=None):
+        """
+        Самый похожий невыполненный адрес с теми же номерами дома и корпуса,
+        типом улицы и округом (коэффициент Дайса по триграммам); длина названия
+        улицы может отличаться не больше чем на MKD_FUZZY_MAX_LENGTH_DIFF букв.
+        Возвращает (item, сходство) или (None, 0.0).
+        """
+        threshold = MKD_FUZZY_THRESHOLD if threshold is None else threshold
+        bucket_key, canonical, name = _fuzzy_key(cleaned_address)
+        bucket = self.fuzzy_buckets.get(bucket_key)
+        if not canonical or not bucket:
+            return None, 0.0
+        grams = _trigrams(canonical)
         
-        if not sheet_exists:
-            log_warn(f"[MKD] Лист '{MKD_SHEET_NAME}' не найден в таблице. Проверка адресов отключена.")
-            mkd_addresses_cache = []
-            mkd_addresses_cache_time = current_time
-            return []
-        
-        log_info(f"[MKD] Загрузка адресов из листа '{MKD_SHEET_NAME}', столбцы D и K")
-        
-        # Получаем все данные из столбцов D (адрес) и K (статус)
-        result = sheets.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f'{MKD_SHEET_NAME}!D:K'
-        ).execute()
-        
-        values = result.get('values', [])
+        best, best_score = None, 0.0
+        with self.fuzzy_lock:
+            for entry in bucket:
+                item, entry_canonical, entry_name, entry_grams = entry
+                if item['status'] == 'выполнено':
+                    continue
+                if abs(len(entry_name) - len(name)) > MKD_FUZZY_MAX_LENGTH_DIFF:
+                    continue
+                if entry_grams is None:
+                    entry_grams = entry[3] = _trigrams(entry_canonical)
+                score = 2 * len(grams & entry_grams) / (len(grams) + len(entry_grams))
+                if score > best_score:
+                    best, best_score = item, score
+        if best is None or best_score < threshold:
+            return None, best_score
+        return best, best_score
+
+# ============ ФУНКЦИИ РАБОТЫ С ЛИСТОМ МКД ============
+def _set_mkd_cache(addresses_with_rows, cache_time):
+    global mkd_addresses_cache, mkd_addresses_cache_time, mkd_address_index
+    mkd_address_index = MKDAddressIndex(addresses_with_rows)
+    mkd_addresses_cache = addresses_with_rows
+    mkd_addresses_cache_time = cache_time
+
+def _read_mkd_sheet(sheets):
+    """
+    Читает столбцы D (адрес) и K (статус) листа МКД одним запросом, без столбцов E:J.
+    Возвращает список словарей: [{'row': номер_строки, 'address': адрес, 'status': статус}, ...]
+    """
+    result = execute_request(sheets.values().batchGet(
+        spreadsheetId=SPREADSHEET_ID,
+        ranges=[f'{MKD_SHEET_NAME}!D:D', f'{MKD_SHEET_NAME}!K:K']
+    ), 'sheets', PRIORITY_MAINTENANCE)
+    value_ranges = result.get('valueRanges', [])
+    addresses = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+    statuses = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+    
+    # Извлекаем адреса с номерами строк
+    addresses_with_rows = []
+    for idx, row in enumerate(addresses, start=1):
+        address = row[0].strip() if row and row[0] else ""
+        status_row = statuses[idx - 1] if idx - 1 < len(statuses) else []
+        status = status_row[0].strip() if status_row else ""
+        if address and address.lower() != "адрес" and address.lower() != "address":
+            addresses_with_rows.append({
+                'row': idx,
+                'address': address,
+                'status': status
+            })
+    return addresses_with_rows
+
+def refresh_mkd_addresses(sheets):
+    """
+    Перечитывает лист МКД. Если адреса не изменились, в кэше обновляются только
+    статусы (индексы не перестраиваются). При ошибке остается прежний кэш.
+    """
+    global mkd_addresses_cache_time
+    with mkd_refresh_lock:
+        current_time = datetime.now().timestamp()
+        try:
+            addresses_with_rows = _read_mkd_sheet(sheets)
+        except HttpError as e:
+            if e.resp.status in (400, 404):
+                log_warn(f"[MKD] Лист '{MKD_SHEET_NAME}' не найден. Проверка адресов отключена.")
+                _set_mkd_cache([], current_time)
+            else:
+                log_error(f"[MKD] Ошибка загрузки адресов: {e}")
+            return mkd_addresses_cache or []
+        except Exception as e:
+            log_error(f"[MKD] Ошибка загрузки адресов: {e}")
+            return mkd_addresses_cache or []
         
-        # Извлекаем адреса с номерами строк
-        addresses_with_rows = []
-        for idx, row in enumerate(values, start=1):
-            if row and len(row) >= 1:
-                address = row[0].strip() if row[0] else ""
-                # Статус из колонки K (индекс 7 в полученном диапазоне)
-                status = row[7].strip() if len(row) > 7 else ""
-                if address and address.lower() != "адрес" and address.lower() != "address":
-                    addresses_with_rows.append({
-                        'row': idx,
-                        'address': address,
-                        'status': status
-                    })
+        old_items = mkd_addresses_cache
+        if old_items is not None and len(old_items) == len(addresses_with_rows) and all(
+            old['row'] == new['row'] and old['address'] == new['address']
+            for old, new in zip(old_items, addresses_with_rows)
+        ):
+            changed = _apply_mkd_statuses(old_items, addresses_with_rows)
+            mkd_addresses_cache_time = current_time
+            log_info(f"[MKD] Кэш адресов обновлен, адреса без изменений, статусов изменено: {changed}")
+            return old_items
         
+        _apply_mkd_statuses(addresses_with_rows, addresses_with_rows)
+        _set_mkd_cache(addresses_with_rows, current_time)
         log_info(f"[MKD] Загружено {len(addresses_with_rows)} адресов")
-        
-        # Сохраняем в кэш
-        mkd_addresses_cache = addresses_with_rows
-        mkd_addresses_cache_time = current_time
-        
         return addresses_with_rows
-        
-    except HttpError as e:
-        if e.resp.status == 404:
-            log_warn(f"[MKD] Лист '{MKD_SHEET_NAME}' не найден. Проверка адресов отключена.")
-        else:
-            log_error(f"[MKD] Ошибка загрузки адресов: {e}")
-        mkd_addresses_cache = []
-        mkd_addresses_cache_time = current_time
-        return []
-    except Exception as e:
-        log_error(f"[MKD] Ошибка загрузки адресов: {e}")
-        mkd_addresses_cache = []
-        mkd_addresses_cache_time = current_time
-        return []
 
-def update_mkd_status(sheets, row_number):
-    """Обновляет статус в колонке K листа МКД на 'выполнено'"""
+def _apply_mkd_statuses(cached_items, sheet_items):
+    """
+    Переносит статусы из листа в кэш. Строки, отмеченные ботом, остаются
+    "выполнено", пока лист не подтвердит отметку (запись могла еще не дойти).
+    """
+    changed = 0
+    with mkd_match_lock:
+        for item, sheet_item in zip(cached_items, sheet_items):
+            status = sheet_item['status']
+            if item['row'] in mkd_locally_marked:
+                if status == 'выполнено':
+                    mkd_locally_marked.discard(item['row'])
+                else:
+                    status = 'выполнено'
+            if item['status'] != status:
+                item['status'] = status
+                changed += 1
+    return changed
+
+def load_mkd_addresses_with_rows(sheets):
+    """
+    Адреса из листа Обследование МКД (столбец D) с номерами строк.
+    Лист читается только при первом вызове, дальше кэш обновляется в фоне (mkd_refresh_loop).
+    Возвращает список словарей: [{'row': номер_строки, 'address': адрес, 'status': статус}, ...]
+    """
+    if mkd_addresses_cache is not None:
+        return mkd_addresses_cache
+    log_info(f"[MKD] Загрузка адресов из листа '{MKD_SHEET_NAME}', столбцы D и K")
+    return refresh_mkd_addresses(sheets)
+
+async def mkd_refresh_loop():
+    """Обновляет кэш МКД в фоне до истечения CACHE_DURATION, поиск всегда идет по памяти"""
+    while True:
+        await asyncio.sleep(MKD_REFRESH_INTERVAL)
+        try:
+            sheets = init_google_sheets()
+            if sheets:
+                await run_blocking(refresh_mkd_addresses, sheets)
+            if mkd_addresses_cache_time is not None:
+                age = datetime.now().timestamp() - mkd_addresses_cache_time
+                if age > CACHE_DURATION:
+                    log_warn(f"[MKD] Кэш адресов не обновлялся {int(age)} с")
+        except Exception as e:
+            log_error(f"[MKD] Ошибка фонового обновления: {e}")
+
+def update_mkd_statuses(sheets, row_numbers):
+    """Ставит 'выполнено' в колонку K листа МКД сразу для нескольких строк (один values.batchUpdate)"""
     try:
-        range_name = f'{MKD_SHEET_NAME}!K{row_number}'
-        body = {'values': [['выполнено']]}
-        
-        sheets.values().update(
+        data = [
+            {'range': f'{MKD_SHEET_NAME}!K{row_number}', 'values': [['выполнено']]}
+            for row_number in row_numbers
+        ]
+        execute_request(sheets.values().batchUpdate(
             spreadsheetId=SPREADSHEET_ID,
-            range=range_name,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-        log_info(f"[MKD] Обновлен статус в строке {row_number} на 'выполнено'")
+            body={'valueInputOption': 'USER_ENTERED', 'data': data}
+        ), 'sheets', PRIORITY_BACKGROUND)
+        log_info(f"[MKD] Обновлен статус 'выполнено' в строках: {', '.join(map(str, row_numbers))}")
         return True
     except Exception as e:
-        log_error(f"[MKD] Ошибка обновления статуса в строке {row_number}: {e}")
+        log_error(f"[MKD] Ошибка обновления статуса в строках {row_numbers}: {e}")
         return False
 
-def check_and_mark_address_in_mkd(sheets, address):
+class MKDStatusWriter:
+    """
+    Очередь отметок 'выполнено' для листа МКД. Отметки копятся и уходят одним
+    values.batchUpdate раз в MKD_STATUS_FLUSH_INTERVAL секунд или по
+    MKD_STATUS_BATCH_SIZE строк. Повторная отметка строки, уже стоящей в очереди,
+    игнорируется; при ошибке пакет повторяется с экспоненциальной задержкой.
+    Очередь хранится и в базе состояния (attach): после перезапуска или
+    падения процесса недописанные отметки уходят в лист.
+    """
+    
+    def __init__(self, interval=None, batch_size=None):
+        self.interval = interval or MKD_STATUS_FLUSH_INTERVAL
+        self.batch_size = batch_size or MKD_STATUS_BATCH_SIZE
+        self.pending = set()
+        self.failures = 0
+        self.wakeup = asyncio.Event()
+        self.store = None
+    
+    def attach(self, store):
+        """Подключает базу состояния и возвращает в очередь отметки, не записанные до остановки"""
+        self.store = store
+        restored = store.load_mkd_pending()
+        self.pending.update(restored)
+        # До подтверждения листом эти строки считаются выполненными и в кэше МКД
+        mkd_locally_marked.update(restored)
+        if restored:
+            log_info(f"[MKD] Восстановлено отметок из базы: {len(restored)}")
+    
+    def mark(self, row_number):
+        if row_number in self.pending:
+            return False
+        self.pending.add(row_number)
+        if self.store is not None:
+            try:
+                self.store.save_mkd_pending(row_number)
+            except sqlite3.Error as e:
+                log_error(f"[MKD] Не удалось сохранить отметку строки {row_number}: {e}")
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+        return True
+    
+    async def flush(self):
+        if not self.pending:
+            return True
+        row_numbers = sorted(self.pending)[:self.batch_size]
+        sheets = init_google_sheets()
+        ok = bool(sheets) and await run_blocking(update_mkd_statuses, sheets, row_numbers)
+        if ok:
+            self.pending.difference_update(row_numbers)
+            self.failures = 0
+            if self.store is not None:
+                try:
+                    self.store.delete_mkd_pending(row_numbers)
+                except sqlite3.Error as e:
+                    log_error(f"[MKD] Не удалось удалить записанные отметки из базы: {e}")
+        else:
+            self.failures += 1
+        return ok
+    
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                while self.pending:
+                    if not await self.flush():
+                        delay = min(MKD_STATUS_RETRY_MAX_DELAY, self.interval * 2 ** self.failures)
+                        delay *= random.uniform(0.5, 1.0)
+                        log_warn(f"[MKD] Повтор записи статусов через {delay:.1f} с ({len(self.pending)} строк в очереди)")
+                        await asyncio.sleep(delay)
+                        continue
+                    if len(self.pending) < self.batch_size:
+                        break
+            except Exception as e:
+                log_error(f"[MKD] Ошибка очереди статусов: {e}")
+    
+    async def close(self):
+        """Дописывает накопленные отметки (при остановке)"""
+        if self.pending:
+            await self.flush()
+
+mkd_status_writer = MKDStatusWriter()
+
+def check_and_mark_address_in_mkd(address):
     """
     Проверяет наличие адреса в листе МКД.
-    Сравнивает адрес без подъездов и этажей, но С КОРПУСОМ
+    Сравнивает адрес без подъездов и этажей, но С КОРПУСОМ.
+    Работает только с памятью: отметка в листе ставится в очередь mkd_status_writer.
     """
     if not address:
         return False, None
@@ -326,48 +949,147 @@ def check_and_mark_address_in_mkd(sheets, address):
     # Очищаем адрес от подъездов и этажей (корпус сохраняется)
     cleaned_address = clean_address_for_mkd(address)
     
-    addresses_with_rows = load_mkd_addresses_with_rows(sheets)
+    # Поиск только по памяти: кэш обновляется в фоне
+    index = mkd_address_index
     
-    if not addresses_with_rows:
+    if index is None or not index.items:
         return False, None
     
-    # Нормализуем очищенный адрес для сравнения
-    clean_addr = re.sub(r'\s+', ' ', cleaned_address.strip().lower())
-    clean_addr = re.sub(r'\s*,\s*', ',', clean_addr)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        log_debug("[MKD] Поиск адреса: '%s'", normalize_mkd_address(cleaned_address))
     
-    log_info(f"[MKD] Поиск адреса: '{clean_addr}'")
-    
-    for item in addresses_with_rows:
-        # Пропускаем уже выполненные
-        if item['status'] == 'выполнено':
-            continue
+    with mkd_match_lock:
+        item, exact = index.find(cleaned_address)
+        if item is not None:
+            if exact:
+                log_info(f"[MKD] ТОЧНОЕ СОВПАДЕНИЕ: '{item['address']}' (строка {item['row']})")
+            else:
+                log_info(f"[MKD] СОВПАДЕНИЕ (без запятых): '{item['address']}' (строка {item['row']})")
+        elif MKD_FUZZY_THRESHOLD < 1:
+            item, score = index.find_fuzzy(cleaned_address)
+            if item is not None:
+                log_info(f"[MKD] НЕЧЕТКОЕ СОВПАДЕНИЕ ({score:.2f}): '{item['address']}' (строка {item['row']})")
         
-        clean_mkd = re.sub(r'\s+', ' ', item['address'].lower())
-        clean_mkd = re.sub(r'\s*,\s*', ',', clean_mkd)
+        if item is None:
+            log_debug("[MKD] Адрес не найден: %s", cleaned_address)
+            return False, None
         
-        # Точное сравнение
-        if clean_addr == clean_mkd:
-            log_info(f"[MKD] ТОЧНОЕ СОВПАДЕНИЕ: '{item['address']}' (строка {item['row']})")
-            update_mkd_status(sheets, item['row'])
-            return True, item['address']
-        
-        # Сравнение без учета лишних пробелов и запятых
-        if clean_addr.replace(',', '') == clean_mkd.replace(',', ''):
-            log_info(f"[MKD] СОВПАДЕНИЕ (без запятых): '{item['address']}' (строка {item['row']})")
-            update_mkd_status(sheets, item['row'])
-            return True, item['address']
+        # Отмечаем в кэше сразу, чтобы строку не нашли повторно до следующего обновления
+        item['status'] = 'выполнено'
+        mkd_locally_marked.add(item['row'])
     
-    log_info(f"[MKD] Адрес не найден: {cleaned_address}")
-    return False, None
+    mkd_status_writer.mark(item['row'])
+    return True, item['address']
 
 # ============ ВЕБ-СЕРВЕР ============
 async def handle_ping(request):
-    return web.Response(text=f"Bot is running! Moscow time: {get_moscow_datetime_str()}")
+    return web.Response(
+        text=f"Bot is running! Moscow time: {get_moscow_datetime_str()}\n"
+             f"Google API: {get_google_client_stats_str()}"
+    )
+
+def _json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=functools.partial(json.dumps, ensure_ascii=False))
+
+def _query_date(value):
+    """Дата из параметра запроса: today, ДД.ММ.ГГГГ или ГГГГ-ММ-ДД -> ГГГГ-ММ-ДД"""
+    if not value:
+        return None
+    if value == 'today':
+        return get_moscow_time().strftime("%Y-%m-%d")
+    iso_date = TicketMirror.iso_date(value)
+    if iso_date is None:
+        raise web.HTTPBadRequest(text=f"Неверная дата: {value}")
+    return iso_date
+
+def _query_filters(request):
+    """Общие фильтры /tickets и /stats"""
+    query = request.query
+    date = _query_date(query.get('date'))
+    filters = {
+        'district': query.get('district') or None,
+        'tt': query.get('tt') or None,
+        'status': query.get('status') or None,
+        'date_from': date or _query_date(query.get('from')),
+        'date_to': date or _query_date(query.get('to')),
+        'open_only': None,
+    }
+    if query.get('open'):
+        filters['open_only'] = query['open'].lower() in ('1', 'true', 'yes')
+    return filters
+
+def _check_api_token(request):
+    if not TICKETS_API_TOKEN:
+        raise web.HTTPNotFound(text="TICKETS_API_TOKEN не задан")
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):].strip()
+    else:
+        token = request.headers.get('X-Api-Token', '')
+    if not token:
+        raise web.HTTPUnauthorized(text="Нужен токен TICKETS_API_TOKEN")
+    if not hmac.compare_digest(token.encode(), TICKETS_API_TOKEN.encode()):
+        raise web.HTTPForbidden(text="Неверный токен")
+
+async def handle_tickets(request):
+    """
+    Заявки из локальной копии листа, новые первыми. Параметры: district, tt, status,
+    date (today, ДД.ММ.ГГГГ), from/to, open=1|0, limit, offset.
+    """
+    _check_api_token(request)
+    if ticket_mirror.conn is None:
+        return _json_response({'error': "Копия листа ведется в процессе записи"}, status=503)
+    filters = _query_filters(request)
+    try:
+        limit = max(0, min(int(request.query.get('limit', TICKETS_DEFAULT_LIMIT)), TICKETS_MAX_LIMIT))
+        offset = max(0, int(request.query.get('offset', 0)))
+    except ValueError:
+        raise web.HTTPBadRequest(text="limit и offset - целые числа")
+    total, tickets = await run_blocking(ticket_mirror.query_tickets, limit=limit, offset=offset,
+                                        executor=local_executor, **filters)
+    return _json_response({'total': total, 'limit': limit, 'offset': offset, 'tickets': tickets})
+
+async def handle_stats(request):
+    """Число заявок и открытых по округам и статусам; фильтры те же, что у /tickets"""
+    _check_api_token(request)
+    if ticket_mirror.conn is None:
+        return _json_response({'error': "Копия листа ведется в процессе записи"}, status=503)
+    stats = await run_blocking(ticket_mirror.stats, executor=local_executor, **_query_filters(request))
+    return _json_response(stats)
+
+def collect_gauges():
+    """Текущие значения очередей и кэшей для /metrics"""
+    gauges = [
+        ('bot_ingest_queue_depth', {}, ingest_queue.depth() if ingest_queue.conn is not None else 0),
+        ('bot_send_queue_depth', {}, telegram_sender.queue.qsize()),
+        ('bot_sheet_buffer_rows', {}, len(sheet_writer.items)),
+        ('bot_mkd_status_pending', {}, len(mkd_status_writer.pending)),
+        ('bot_sheet_format_pending', {}, len(sheet_format_queue.pending)),
+        ('bot_photo_memory_bytes', {}, photo_memory_budget.used),
+        ('bot_duplicate_index_rows', {}, len(duplicate_index.row_keys)),
+        ('bot_mkd_cache_addresses', {}, len(mkd_addresses_cache or [])),
+    ]
+    if ticket_mirror.conn is not None:
+        gauges.append(('bot_ticket_mirror_rows', {}, ticket_mirror.row_count))
+    if mkd_addresses_cache_time is not None:
+        gauges.append(('bot_mkd_cache_age_seconds', {}, round(datetime.now().timestamp() - mkd_addresses_cache_time, 3)))
+    return gauges
+
+async def handle_metrics(request):
+    return web.Response(
+        text=metrics.render(collect_gauges()),
+        content_type='text/plain',
+        charset='utf-8',
+        headers={'X-Content-Type-Options': 'nosniff'}
+    )
 
 async def start_web_server():
     global web_app
     web_app = web.Application()
     web_app.router.add_get('/ping', handle_ping)
+    web_app.router.add_get('/metrics', handle_metrics)
+    web_app.router.add_get('/tickets', handle_tickets)
+    web_app.router.add_get('/stats', handle_stats)
     
     port = int(os.environ.get('PORT', 10000))
     runner = web.AppRunner(web_app)
@@ -377,148 +1099,565 @@ async def start_web_server():
     log_info(f"[WEB] Сервер запущен на порту {port}")
 
 # ============ ФУНКЦИИ GOOGLE SHEETS ============
+def _count_google_stat(key, amount=1):
+    with google_client_stats_lock:
+        google_client_stats[key] += amount
+
+def _import_google_modules():
+    global httplib2, service_account, AuthorizedHttp, build_from_document, get_static_doc, HttpRequest, MediaIoBaseUpload
+    if build_from_document is not None:
+        return
+    import httplib2
+    from google.oauth2 import service_account
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery_cache import get_static_doc
+    from googleapiclient.http import HttpRequest, MediaIoBaseUpload
+    from googleapiclient.discovery import build_from_document
+
+def _new_http():
+    """
+    httplib2.Http для Google API. 308 у Drive означает "загрузка по частям не завершена",
+    а не редирект: без этого resumable-загрузка падает с RedirectMissingLocation
+    (так же настраивает свой клиент googleapiclient.http.build_http).
+    """
+    http = httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+    http.redirect_codes = http.redirect_codes - {308}
+    return http
+
+def _get_thread_http():
+    """
+    HTTP-клиент текущего потока. httplib2.Http не потокобезопасен, поэтому
+    у каждого потока свой клиент, а его keep-alive соединения живут между запросами.
+    """
+    http = getattr(_thread_http, 'http', None)
+    if http is None:
+        http = AuthorizedHttp(google_credentials, http=_new_http())
+        _thread_http.http = http
+        _count_google_stat('connections_opened')
+    else:
+        _count_google_stat('connections_reused')
+    return http
+
+def _build_request(http, *args, **kwargs):
+    """requestBuilder для discovery-клиентов: каждый запрос идет через HTTP-клиент своего потока"""
+    return HttpRequest(_get_thread_http(), *args, **kwargs)
+
+def _build_google_service(name, version):
+    # Discovery-документ берется из пакета googleapiclient, без запроса к Google
+    document = json.loads(get_static_doc(name, version))
+    if GOOGLE_API_ROOT_URL:
+        # rootUrl меняется в самом документе, иначе загрузка файлов ушла бы на googleapis.com
+        document['rootUrl'] = GOOGLE_API_ROOT_URL.rstrip('/') + '/'
+        document['baseUrl'] = document['rootUrl'] + document['servicePath']
+    service = build_from_document(
+        document,
+        http=AuthorizedHttp(google_credentials, http=_new_http()),
+        requestBuilder=_build_request
+    )
+    _count_google_stat('builds')
+    return service
+
+def init_google_clients():
+    """Создает общие клиенты Sheets и Drive один раз на весь процесс"""
+    global google_credentials, sheets_service, drive_service
+    with google_clients_lock:
+        if sheets_service is not None and drive_service is not None:
+            return True
+        try:
+            _import_google_modules()
+            if google_credentials is None:
+                google_credentials = service_account.Credentials.from_service_account_info(
+                    json_data,
+                    scopes=GOOGLE_SCOPES
+                )
+            if sheets_service is None:
+                sheets_service = _build_google_service('sheets', 'v4').spreadsheets()
+                log_info("[OK] Подключение к Google Sheets API")
+            if drive_service is None:
+                drive_service = _build_google_service('drive', 'v3')
+                log_info("[OK] Подключение к Google Drive API")
+            return True
+        except Exception as e:
+            log_error(f"Ошибка инициализации Google API: {e}")
+            return False
+
 def init_google_sheets():
-    try:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
-        )
-        service = build('sheets', 'v4', credentials=credentials)
-        log_info("[OK] Подключение к Google Sheets API")
-        return service.spreadsheets()
-    except Exception as e:
-        log_error(f"Ошибка Google Sheets: {e}")
+    """Возвращает общий клиент Google Sheets (создается только при первом вызове)"""
+    if sheets_service is not None:
+        return sheets_service
+    if not init_google_clients():
         return None
+    return sheets_service
 
-def get_last_row(sheets):
-    try:
-        result = sheets.values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f'{SHEET_NAME}!A:A'
-        ).execute()
-        values = result.get('values', [])
-        return len(values) + 1
-    except Exception as e:
-        log_error(f"Ошибка получения строки: {e}")
-        return 1
+def get_drive_service():
+    """Возвращает общий клиент Google Drive (создается только при первом вызове)"""
+    if drive_service is not None:
+        return drive_service
+    if not init_google_clients():
+        return None
+    return drive_service
+
+def get_google_client_stats_str():
+    with google_client_stats_lock:
+        stats = dict(google_client_stats)
+    return (
+        f"клиентов создано: {stats['builds']}, сборок сэкономлено: {stats['builds_saved']}, "
+        f"соединений открыто: {stats['connections_opened']}, "
+        f"запросов по открытым соединениям: {stats['connections_reused']}, "
+        f"повторов: {stats['retries']}, ожиданий квоты: {stats['throttled']}"
+    )
+
+# ============ ЛИМИТЫ GOOGLE API ============
+class GoogleRateLimiter:
+    """
+    Token bucket на каждый API (квота в минуту + запас на всплеск) с приоритетами:
+    пока квоты ждет запрос с более высоким приоритетом, менее важные не проходят.
+    После 429 скорость API временно снижается вдвое и постепенно восстанавливается
+    на успешных ответах. Вызывается из потоков пула, ожидание блокирует поток,
+    а вместе с ним и вызывающую корутину (backpressure вместо ошибки).
+    """
+    
+    def __init__(self, quotas_per_minute, burst):
+        self.condition = threading.Condition()
+        self.buckets = {
+            api: {
+                'rate': quota / 60.0,  # токенов в секунду при полной скорости
+                'factor': 1.0,         # доля скорости после 429
+                'tokens': float(min(burst, quota)),
+                'capacity': float(min(burst, quota)),
+                'updated': time.monotonic(),
+                'paused_until': 0.0,
+                'waiting': Counter()   # priority -> число ожидающих
+            }
+            for api, quota in quotas_per_minute.items()
+        }
+    
+    def _refill(self, bucket, now):
+        rate = bucket['rate'] * bucket['factor']
+        bucket['tokens'] = min(bucket['capacity'], bucket['tokens'] + (now - bucket['updated']) * rate)
+        bucket['updated'] = now
+    
+    def _wait_time(self, bucket, priority, now):
+        """0, если токен можно взять сейчас, иначе сколько ждать"""
+        if any(count for p, count in bucket['waiting'].items() if p < priority):
+            return 0.05
+        if now < bucket['paused_until']:
+            return bucket['paused_until'] - now
+        if bucket['tokens'] >= 1:
+            return 0
+        return (1 - bucket['tokens']) / (bucket['rate'] * bucket['factor'])
+    
+    def acquire(self, api, priority=PRIORITY_TICKET):
+        bucket = self.buckets[api]
+        with self.condition:
+            bucket['waiting'][priority] += 1
+            throttled = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(bucket, now)
+                    delay = self._wait_time(bucket, priority, now)
+                    if delay <= 0:
+                        bucket['tokens'] -= 1
+                        break
+                    throttled = True
+                    self.condition.wait(timeout=delay)
+            finally:
+                bucket['waiting'][priority] -= 1
+                self.condition.notify_all()
+        if throttled:
+            _count_google_stat('throttled')
+            metrics.inc('google_api_throttled_total', api=api)
+    
+    def on_success(self, api):
+        bucket = self.buckets[api]
+        if bucket['factor'] < 1:
+            with self.condition:
+                bucket['factor'] = min(1.0, bucket['factor'] + 0.05)
+    
+    def on_rate_limited(self, api, delay):
+        """429: все запросы к API ждут delay секунд, скорость снижается"""
+        bucket = self.buckets[api]
+        with self.condition:
+            now = time.monotonic()
+            self._refill(bucket, now)
+            bucket['factor'] = max(0.1, bucket['factor'] / 2)
+            bucket['tokens'] = 0.0
+            bucket['paused_until'] = max(bucket['paused_until'], now + delay)
+            self.condition.notify_all()
+
+google_rate_limiter = GoogleRateLimiter(GOOGLE_QUOTA_PER_MINUTE, GOOGLE_QUOTA_BURST)
+
+def _is_rate_limit_error(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    # Drive сообщает о превышении квоты кодом 403
+    return error.resp.status == 403 and b'ateLimitExceeded' in (error.content or b'')
+
+def _is_retryable_error(error):
+    if isinstance(error, HttpError):
+        return error.resp.status >= 500 or _is_rate_limit_error(error)
+    return isinstance(error, OSError) or (httplib2 is not None and isinstance(error, httplib2.HttpLib2Error))
+
+def _is_not_applied_error(error):
+    """
+    Ошибки, после которых запрос точно не выполнен: квота (429), 503
+    или соединение не установлено. Таймаут, обрыв и остальные 5xx
+    не дают такой гарантии - запрос мог дойти до Google.
+    """
+    if isinstance(error, HttpError):
+        return error.resp.status == 503 or _is_rate_limit_error(error)
+    if httplib2 is not None and isinstance(error, httplib2.ServerNotFoundError):
+        return True
+    return isinstance(error, ConnectionRefusedError)
+
+def execute_request(request, api='sheets', priority=PRIORITY_TICKET, idempotent=True):
+    """
+    Выполняет запрос Google API с учетом квоты и повторами при 429/5xx
+    и сетевых ошибках (экспоненциальная задержка со случайным разбросом).
+    Неидемпотентные запросы (idempotent=False: append, создание файлов)
+    повторяются только при ошибках, после которых запрос точно не выполнен.
+    Вызывается только из потоков пула (run_blocking).
+    """
+    method = getattr(request, 'methodId', None) or api
+    for attempt in range(GOOGLE_MAX_RETRIES + 1):
+        google_rate_limiter.acquire(api, priority)
+        metrics.inc('google_api_requests_total', api=api, method=method)
+        try:
+            result = request.execute()
+        except Exception as e:
+            code = e.resp.status if isinstance(e, HttpError) else type(e).__name__
+            metrics.inc('google_api_errors_total', api=api, method=method, code=code)
+            retryable = _is_retryable_error(e) if idempotent else _is_not_applied_error(e)
+            if attempt >= GOOGLE_MAX_RETRIES or not retryable:
+                raise
+            delay = random.uniform(0, min(GOOGLE_RETRY_MAX_DELAY, GOOGLE_RETRY_BASE_DELAY * 2 ** attempt))
+            if _is_rate_limit_error(e):
+                google_rate_limiter.on_rate_limited(api, delay)
+            _count_google_stat('retries')
+            metrics.inc('google_api_retries_total', api=api)
+            log_warn(f"[GOOGLE] {api}: {e}. Повтор через {delay:.1f} с (попытка {attempt + 1})")
+            time.sleep(delay)
+            continue
+        google_rate_limiter.on_success(api)
+        return result
+
+def _parse_updated_row(updated_range):
+    """Номер первой строки из ответа append, например "'Лист'!A125:S125" -> 125"""
+    match = re.search(r'![A-Z]+(\d+)', updated_range or '')
+    return int(match.group(1)) if match else None
 
 def get_sheet_id(sheets):
+    """sheetId основного листа (запрашивается один раз, дальше берется из кэша)"""
+    global sheet_id_cache
+    if sheet_id_cache is not None:
+        return sheet_id_cache
     try:
-        spreadsheet = sheets.get(spreadsheetId=SPREADSHEET_ID).execute()
+        spreadsheet = execute_request(sheets.get(spreadsheetId=SPREADSHEET_ID), 'sheets', PRIORITY_TICKET)
         sheets_list = spreadsheet.get('sheets', [])
         for sheet in sheets_list:
             properties = sheet.get('properties', {})
             if properties.get('title') == SHEET_NAME:
-                return properties.get('sheetId')
+                sheet_id_cache = properties.get('sheetId')
+                return sheet_id_cache
         return 0
     except Exception as e:
         log_error(f"Ошибка получения sheetId: {e}")
         return 0
 
-def write_to_google_sheets(sheets, data, is_duplicate=False, mkd_found=False):
-    """Запись данных в Google таблицу"""
-    try:
-        next_row = get_last_row(sheets)
-        
-        # Если найден в МКД, добавляем отметку в колонку S
-        if mkd_found:
-            data[COL['MKD_STATUS']-1] = "Обследование"
-            log_info(f"[MKD] Добавлена отметка 'Обследование' в колонку S")
-        
-        range_name = f'{SHEET_NAME}!A{next_row}:S{next_row}'  # Расширяем до колонки S
-        body = {'values': [data]}
-        
-        sheets.values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_name,
-            valueInputOption='USER_ENTERED',
-            body=body
-        ).execute()
-        
-        # Установка флажков
-        sheet_id = get_sheet_id(sheets)
-        requests = []
-        
-        # Флажок в A
-        requests.append({
-            "repeatCell": {
-                "range": {
-                    "sheetId": sheet_id,
-                    "startRowIndex": next_row - 1,
-                    "endRowIndex": next_row,
-                    "startColumnIndex": 0,
-                    "endColumnIndex": 1
-                },
-                "cell": {
-                    "dataValidation": {"condition": {"type": "BOOLEAN"}},
-                    "userEnteredValue": {"boolValue": False}
-                },
-                "fields": "dataValidation,userEnteredValue"
-            }
-        })
-        
-        # Флажок в L
-        requests.append({
-            "repeatCell": {
-                "range": {
-                    "sheetId": sheet_id,
-                    "startRowIndex": next_row - 1,
-                    "endRowIndex": next_row,
-                    "startColumnIndex": 11,
-                    "endColumnIndex": 12
-                },
-                "cell": {
-                    "dataValidation": {"condition": {"type": "BOOLEAN"}},
-                    "userEnteredValue": {"boolValue": False}
-                },
-                "fields": "dataValidation,userEnteredValue"
-            }
-        })
-        
-        # Красный цвет для дубликатов
-        if is_duplicate:
-            for col in [9, 17]:
-                requests.append({
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": sheet_id,
-                            "startRowIndex": next_row - 1,
-                            "endRowIndex": next_row,
-                            "startColumnIndex": col,
-                            "endColumnIndex": col + 1
-                        },
-                        "cell": {
-                            "userEnteredFormat": {
-                                "textFormat": {
-                                    "foregroundColor": {"red": 1, "green": 0, "blue": 0},
-                                    "bold": True
-                                }
-                            }
-                        },
-                        "fields": "userEnteredFormat.textFormat"
+def _checkbox_request(sheet_id, first_row, last_row, col):
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": first_row - 1,
+                "endRowIndex": last_row,
+                "startColumnIndex": col,
+                "endColumnIndex": col + 1
+            },
+            "cell": {
+                "dataValidation": {"condition": {"type": "BOOLEAN"}},
+                "userEnteredValue": {"boolValue": False}
+            },
+            "fields": "dataValidation,userEnteredValue"
+        }
+    }
+
+def _duplicate_format_request(sheet_id, row_number, col):
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": row_number - 1,
+                "endRowIndex": row_number,
+                "startColumnIndex": col,
+                "endColumnIndex": col + 1
+            },
+            "cell": {
+                "userEnteredFormat": {
+                    "textFormat": {
+                        "foregroundColor": {"red": 1, "green": 0, "blue": 0},
+                        "bold": True
                     }
-                })
-        
-        if requests:
-            sheets.batchUpdate(
+                }
+            },
+            "fields": "userEnteredFormat.textFormat"
+        }
+    }
+
+class SheetFormatQueue:
+    """
+    Оформление записанных строк: флажки в A и L, красный цвет дубликатов.
+    Строки к этому моменту уже в листе, поэтому ошибка оформления не делает
+    запись неудачной: диапазоны остаются в очереди и уходят со следующим
+    пакетом или фоновым повтором раз в SHEET_FORMAT_RETRY_INTERVAL секунд.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []  # (первая строка, последняя строка, строки-дубликаты)
+    
+    def add(self, first_row, last_row, duplicate_rows):
+        with self.lock:
+            self.pending.append((first_row, last_row, list(duplicate_rows)))
+    
+    def flush(self, sheets):
+        """Одним spreadsheets.batchUpdate; при ошибке диапазоны возвращаются в очередь"""
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return True
+        try:
+            sheet_id = get_sheet_id(sheets)
+            if sheet_id_cache is None:
+                raise RuntimeError("не удалось получить sheetId")
+            requests = []
+            for first_row, last_row, duplicate_rows in batch:
+                # Флажки в A и L - одним диапазоном на весь пакет
+                requests.append(_checkbox_request(sheet_id, first_row, last_row, 0))
+                requests.append(_checkbox_request(sheet_id, first_row, last_row, 11))
+                for row_number in duplicate_rows:
+                    for col in [9, 17]:
+                        requests.append(_duplicate_format_request(sheet_id, row_number, col))
+            execute_request(sheets.batchUpdate(
                 spreadsheetId=SPREADSHEET_ID,
                 body={"requests": requests}
-            ).execute()
-        
-        status_text = " (ВОЗВРАТ)" if is_duplicate else ""
-        log_info(f"[OK] Сообщение от {data[COL['USER_ID']-1]} записано в строку {next_row}{status_text}")
-        return next_row
+            ), 'sheets', PRIORITY_TICKET)
+            return True
+        except Exception as e:
+            with self.lock:
+                self.pending[:0] = batch
+            log_warn(f"[SHEETS] Оформление строк {batch[0][0]}-{batch[-1][1]} не применено, повторю позже: {e}")
+            return False
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(SHEET_FORMAT_RETRY_INTERVAL)
+            if not self.pending:
+                continue
+            try:
+                sheets = init_google_sheets()
+                if sheets:
+                    await run_blocking(self.flush, sheets)
+            except Exception as e:
+                log_error(f"[SHEETS] Ошибка повтора оформления: {e}")
+    
+    async def close(self):
+        """Последняя попытка оформить строки (при остановке)"""
+        if self.pending:
+            sheets = init_google_sheets()
+            if sheets:
+                await run_blocking(self.flush, sheets)
+
+sheet_format_queue = SheetFormatQueue()
+
+def _find_appended_rows(sheets, rows):
+    """
+    Ищет пакет в хвосте листа по ключу (chat_id, message_id) в N:O.
+    Возвращает номер первой строки пакета или None, если пакета в листе нет.
+    """
+    start_row = max(2, duplicate_index.last_row - APPEND_VERIFY_TAIL_ROWS + 1)
+    result = execute_request(sheets.values().get(
+        spreadsheetId=SPREADSHEET_ID,
+        range=f'{SHEET_NAME}!N{start_row}:O'
+    ), 'sheets', PRIORITY_TICKET)
+    first_key = [str(rows[0][COL['CHAT_ID']-1]), str(rows[0][COL['MESSAGE_ID']-1])]
+    found = None
+    for offset, row in enumerate(result.get('values', [])):
+        # append атомарен: если есть первая строка пакета, записан весь пакет
+        if [str(value).strip() for value in row[:2]] == first_key:
+            found = start_row + offset
+    return found
+
+def _append_rows(sheets, rows):
+    """
+    values.append пакета строк, возвращает номер первой строки или None.
+    append не идемпотентен: после таймаута или 5xx строки могли записаться,
+    поэтому перед повтором пакет ищется в листе (_find_appended_rows).
+    """
+    # Строки выделяет сам Sheets (append), номера берем из ответа:
+    # не нужно читать столбец A и параллельные записи не попадут в одну строку
+    body = {'values': rows}
+    for attempt in range(APPEND_MAX_ATTEMPTS):
+        try:
+            result = execute_request(sheets.values().append(
+                spreadsheetId=SPREADSHEET_ID,
+                range=f'{SHEET_NAME}!A:S',
+                valueInputOption='USER_ENTERED',
+                insertDataOption='OVERWRITE',
+                body=body
+            ), 'sheets', PRIORITY_TICKET, idempotent=False)
+        except Exception as e:
+            if attempt + 1 >= APPEND_MAX_ATTEMPTS or not _is_retryable_error(e):
+                raise
+            first_row = None if _is_not_applied_error(e) else _find_appended_rows(sheets, rows)
+            if first_row is not None:
+                log_warn(f"[SHEETS] append завершился ошибкой ({e}), но строки уже в листе с {first_row}")
+                return first_row
+            delay = random.uniform(0, min(GOOGLE_RETRY_MAX_DELAY, GOOGLE_RETRY_BASE_DELAY * 2 ** attempt))
+            log_warn(f"[SHEETS] append не выполнен ({e}), повтор через {delay:.1f} с")
+            time.sleep(delay)
+            continue
+        first_row = _parse_updated_row(result.get('updates', {}).get('updatedRange'))
+        if first_row is None:
+            log_error(f"Не удалось определить строку записи: {result}")
+        return first_row
+
+def write_rows_to_google_sheets(sheets, items):
+    """
+    Пакетная запись строк в Google таблицу.
+    items - список (data, is_duplicate, mkd_found).
+    Все строки уходят одним values.append, флажки и выделение дубликатов -
+    одним spreadsheets.batchUpdate. Возвращает список номеров строк или None.
+    После успешного append строки считаются записанными, даже если оформление не прошло.
+    """
+    try:
+        rows = []
+        for data, is_duplicate, mkd_found in items:
+            # Если найден в МКД, добавляем отметку в колонку S
+            if mkd_found:
+                data[COL['MKD_STATUS']-1] = "Обследование"
+                log_info(f"[MKD] Добавлена отметка 'Обследование' в колонку S")
+            rows.append(data)
         
+        first_row = _append_rows(sheets, rows)
+        if first_row is None:
+            return None
     except HttpError as e:
         log_error(f"Ошибка записи: {e}")
         return None
+    
+    last_row = first_row + len(rows) - 1
+    row_numbers = list(range(first_row, last_row + 1))
+    
+    # Строки уже в листе: сначала отмечаем сообщения обработанными,
+    # чтобы никакая ошибка дальше не превратилась в повторную запись
+    metrics.inc('bot_sheet_rows_written_total', len(rows))
+    for row_number, (data, is_duplicate, mkd_found) in zip(row_numbers, items):
+        try:
+            processed_messages.add(data[COL['CHAT_ID']-1], [data[COL['MESSAGE_ID']-1]], row_number)
+            duplicate_index.add_row(row_number, data[COL['TT']-1], data[COL['ADDRESS']-1])
+        except Exception as e:
+            log_error(f"Строка {row_number} записана, но не отмечена в индексах: {e}")
+        status_text = " (ВОЗВРАТ)" if is_duplicate else ""
+        log_info(f"[OK] Сообщение от {data[COL['USER_ID']-1]} записано в строку {row_number}{status_text}")
+    if len(rows) > 1:
+        log_info(f"[SHEETS] Пакет из {len(rows)} строк записан в строки {first_row}-{last_row}")
+    try:
+        ticket_mirror.upsert(zip(row_numbers, rows))
+    except sqlite3.Error as e:
+        log_error(f"[MIRROR] Не удалось обновить копию листа: {e}")
+    
+    # Вместе с оформлением этого пакета уходят и не примененные раньше диапазоны
+    duplicate_rows = [row_number for row_number, (_, is_duplicate, _) in zip(row_numbers, items) if is_duplicate]
+    sheet_format_queue.add(first_row, last_row, duplicate_rows)
+    sheet_format_queue.flush(sheets)
+    return row_numbers
+
+def write_to_google_sheets(sheets, data, is_duplicate=False, mkd_found=False):
+    """Запись одной строки в Google таблицу"""
+    row_numbers = write_rows_to_google_sheets(sheets, [(data, is_duplicate, mkd_found)])
+    return row_numbers[0] if row_numbers else None
+
+class SheetWriteBuffer:
+    """
+    Буфер отложенной записи: строки всех сообщений, пришедших за окно
+    SHEET_BATCH_WINDOW_MS (или набравшие SHEET_BATCH_MAX_ROWS), записываются
+    одним пакетом. Пакеты уходят по очереди, следующий копится, пока пишется текущий.
+    """
+    
+    def __init__(self, window_ms=None, max_rows=None):
+        self.window = (window_ms if window_ms is not None else SHEET_BATCH_WINDOW_MS) / 1000
+        self.max_rows = max_rows or SHEET_BATCH_MAX_ROWS
+        self.items = []  # (data, is_duplicate, mkd_found, future)
+        self.timer = None
+        self.flush_lock = asyncio.Lock()
+    
+    async def write(self, data, is_duplicate=False, mkd_found=False):
+        """Ставит строку в пакет и возвращает номер строки после записи (или None)"""
+        future = asyncio.get_running_loop().create_future()
+        self.items.append((data, is_duplicate, mkd_found, future))
+        self._schedule()
+        return await future
+    
+    def _schedule(self):
+        loop = asyncio.get_running_loop()
+        if len(self.items) >= self.max_rows:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = loop.call_soon(self._on_timer)
+        elif self.timer is None and self.items:
+            self.timer = loop.call_later(self.window, self._on_timer)
+    
+    def _on_timer(self):
+        self.timer = None
+        start_background_task(self.flush())
+    
+    async def flush(self):
+        async with self.flush_lock:
+            batch = self.items[:self.max_rows]
+            del self.items[:len(batch)]
+            if self.items:
+                self._schedule()
+            if not batch:
+                return
+            
+            row_numbers = None
+            try:
+                sheets = init_google_sheets()
+                if sheets:
+                    row_numbers = await run_blocking(
+                        write_rows_to_google_sheets,
+                        sheets,
+                        [(data, is_duplicate, mkd_found) for data, is_duplicate, mkd_found, _ in batch]
+                    )
+                else:
+                    log_error("Нет подключения к Google Sheets")
+            except Exception as e:
+                log_error(f"Ошибка пакетной записи: {e}")
+            
+            for i, (_, _, _, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(row_numbers[i] if row_numbers else None)
+    
+    async def close(self):
+        """Дописывает все, что осталось в буфере (при остановке)"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.items:
+            await self.flush()
+
+sheet_writer = SheetWriteBuffer()
 
 def add_headers_if_needed(sheets):
     try:
-        result = sheets.values().get(
+        result = execute_request(sheets.values().get(
             spreadsheetId=SPREADSHEET_ID,
             range=f'{SHEET_NAME}!A1:S1'
-        ).execute()
+        ), 'sheets', PRIORITY_MAINTENANCE)
         
         values = result.get('values', [])
         
@@ -526,12 +1665,12 @@ def add_headers_if_needed(sheets):
             headers = [[
                 'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M', 'N', 'O', 'P', 'Q', 'R', 'S'
             ]]
-            sheets.values().update(
+            execute_request(sheets.values().update(
                 spreadsheetId=SPREADSHEET_ID,
                 range=f'{SHEET_NAME}!A1:S1',
                 valueInputOption='USER_ENTERED',
                 body={'values': headers}
-            ).execute()
+            ), 'sheets', PRIORITY_MAINTENANCE)
             log_info("[OK] Заголовки добавлены")
     except Exception as e:
         log_warn(f"Ошибка заголовков: {e}")
@@ -563,21 +1702,125 @@ def parse_message_caption(caption):
     return tt, address
 
 # ============ ФУНКЦИИ TELEGRAM ============
-def send_telegram_message(user_id, text, parse_mode="HTML"):
-    import requests
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-    payload = {"chat_id": user_id, "text": text}
-    if parse_mode:
-        payload["parse_mode"] = parse_mode
+class TelegramSender:
+    """
+    Отправка сообщений через Bot API: одна aiohttp-сессия с keep-alive,
+    очередь исходящих и несколько воркеров. Соблюдаются лимиты Telegram
+    (общий - BOT_API_GLOBAL_RATE сообщений в секунду, в один чат - не чаще
+    BOT_API_PER_CHAT_INTERVAL секунд), ответы 429 ждут retry_after.
+    """
     
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        if response.status_code == 200:
-            log_info(f"[OK] Сообщение отправлено пользователю {user_id}")
-        else:
-            log_error(f"Ошибка отправки: {response.text}")
-    except Exception as e:
-        log_error(f"Ошибка: {e}")
+    def __init__(self, workers=None):
+        self.workers = workers or BOT_API_WORKERS
+        self.queue = asyncio.Queue()
+        self.session = None
+        self.tasks = []
+        self.rate_lock = asyncio.Lock()
+        self.next_global = 0.0
+        self.next_per_chat = {}
+        self.flood_until = 0.0
+    
+    async def start(self):
+        if self.session is not None:
+            return
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.workers, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=BOT_API_TIMEOUT)
+        )
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    def enqueue(self, chat_id, text, parse_mode="HTML"):
+        self.queue.put_nowait((chat_id, text, parse_mode, 0))
+    
+    async def _wait_slot(self, chat_id):
+        loop = asyncio.get_running_loop()
+        async with self.rate_lock:
+            now = loop.time()
+            start = max(now, self.next_global, self.next_per_chat.get(chat_id, 0.0))
+            self.next_global = start + 1 / BOT_API_GLOBAL_RATE
+            self.next_per_chat[chat_id] = start + BOT_API_PER_CHAT_INTERVAL
+        if start > now:
+            await asyncio.sleep(start - now)
+        # Flood wait мог начаться, пока ждали своей очереди - занимаем слот заново
+        if loop.time() < self.flood_until:
+            await asyncio.sleep(self.flood_until - loop.time())
+            await self._wait_slot(chat_id)
+    
+    def _postpone(self, chat_id, delay, whole_bot=False):
+        until = asyncio.get_running_loop().time() + delay
+        self.next_per_chat[chat_id] = max(self.next_per_chat.get(chat_id, 0.0), until)
+        if whole_bot:
+            self.next_global = max(self.next_global, until)
+            self.flood_until = max(self.flood_until, until)
+    
+    async def _send(self, chat_id, text, parse_mode):
+        """Возвращает None при успехе или задержку перед повтором; исключение - неповторяемая ошибка"""
+        payload = {"chat_id": chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        url = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/sendMessage"
+        async with self.session.post(url, json=payload) as response:
+            metrics.inc('telegram_api_requests_total', method='sendMessage', status=response.status)
+            if response.status == 200:
+                return None
+            try:
+                data = await response.json(content_type=None)
+            except ValueError:
+                data = {"description": await response.text()}
+            if response.status == 429:
+                retry_after = data.get("parameters", {}).get("retry_after", 1)
+                # Flood wait относится ко всему боту, а не только к этому чату
+                self._postpone(chat_id, retry_after, whole_bot=True)
+                return retry_after
+            if response.status >= 500:
+                return 1.0
+            raise RuntimeError(data.get("description", f"HTTP {response.status}"))
+    
+    async def _worker(self):
+        while True:
+            chat_id, text, parse_mode, attempt = await self.queue.get()
+            try:
+                await self._wait_slot(chat_id)
+                try:
+                    with metrics.timer('bot_stage_duration_seconds', stage='confirmation'):
+                        retry_delay = await self._send(chat_id, text, parse_mode)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    retry_delay = min(2 ** attempt, 30)
+                    metrics.inc('telegram_api_requests_total', method='sendMessage', status=type(e).__name__)
+                    log_warn(f"Ошибка соединения с Bot API: {e}")
+                
+                if retry_delay is None:
+                    log_info(f"[OK] Сообщение отправлено пользователю {chat_id}")
+                elif attempt + 1 >= BOT_API_MAX_RETRIES:
+                    log_error(f"Сообщение пользователю {chat_id} не отправлено после {attempt + 1} попыток")
+                else:
+                    log_warn(f"Повтор отправки пользователю {chat_id} через {retry_delay} с")
+                    metrics.inc('telegram_api_retries_total')
+                    self._postpone(chat_id, retry_delay)
+                    self.queue.put_nowait((chat_id, text, parse_mode, attempt + 1))
+            except Exception as e:
+                log_error(f"Ошибка отправки: {e}")
+            finally:
+                self.queue.task_done()
+    
+    async def close(self, timeout=10):
+        """Дожидается отправки очереди (не дольше timeout секунд) и закрывает сессию"""
+        if self.session is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            log_warn(f"Не отправлено сообщений: {self.queue.qsize()}")
+        for task in self.tasks:
+            task.cancel()
+        await self.session.close()
+        self.session = None
+
+telegram_sender = TelegramSender()
+
+def send_telegram_message(user_id, text, parse_mode="HTML"):
+    """Ставит сообщение в очередь отправки (не блокирует)"""
+    telegram_sender.enqueue(user_id, text, parse_mode)
 
 def send_confirmation(user_id, tt, address, district, photo_link, is_duplicate=False, chat_title="", mkd_found=False, mkd_address=None):
     """Отправка подтверждения с учетом информации о МКД"""
@@ -593,7 +1836,11 @@ def send_confirmation(user_id, tt, address, district, photo_link, is_duplicate=F
     if district:
         message_text += f"Округ: {district}\n"
     if photo_link:
-        message_text += f'Фото: {photo_link}\n'
+        links = photo_link.split("\n")
+        if len(links) > 1:
+            message_text += f"Фото ({len(links)}):\n" + "\n".join(links) + "\n"
+        else:
+            message_text += f'Фото: {photo_link}\n'
     if is_duplicate:
         message_text += f"\n⚠️ Это дублирующаяся заявка!"
     
@@ -605,208 +1852,1777 @@ def send_confirmation(user_id, tt, address, district, photo_link, is_duplicate=F
     
     send_telegram_message(user_id, message_text)
 
-def check_for_duplicate(sheets, tt, address):
-    try:
-        result = sheets.values().get(
+# ============ ИНДЕКС ДУБЛИКАТОВ ============
+class DuplicateIndex:
+    """
+    Индекс пар (TT, адрес) основного листа в памяти.
+    Загружается один раз при старте, пополняется строками, которые пишет бот,
+    и периодически сверяется с последними строками листа (ручные правки).
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()   # ключ -> число строк с этим ключом
+        self.row_keys = {}        # номер строки -> ключ
+        self.pending = Counter()  # ключи сообщений, которые сейчас записываются
+        self.last_row = 1
+        self.loaded = False
+    
+    @staticmethod
+    def make_key(tt, address):
+        return (tt.strip(), address.strip())
+    
+    def _set_row(self, row_number, key):
+        old_key = self.row_keys.pop(row_number, None)
+        if old_key is not None:
+            self.counts[old_key] -= 1
+            if self.counts[old_key] <= 0:
+                del self.counts[old_key]
+        if key is not None:
+            self.row_keys[row_number] = key
+            self.counts[key] += 1
+    
+    @staticmethod
+    def _row_key(row):
+        # Диапазон G:I: G - TT, I - адрес
+        if len(row) < 2:
+            return None
+        row_tt = row[0].strip() if len(row) > 0 else ""
+        row_address = row[2].strip() if len(row) > 2 else ""
+        return (row_tt, row_address)
+    
+    def load(self, sheets):
+        """
+        Полная загрузка столбцов G:I (только при старте). Тем же запросом читаются
+        N:O (CHAT_ID, MESSAGE_ID) для индекса уже записанных сообщений.
+        """
+        result = execute_request(sheets.values().batchGet(
             spreadsheetId=SPREADSHEET_ID,
-            range=f'{SHEET_NAME}!G:I'
-        ).execute()
+            ranges=[f'{SHEET_NAME}!G:I', f'{SHEET_NAME}!N:O']
+        ), 'sheets', PRIORITY_BACKGROUND)
+        value_ranges = result.get('valueRanges', [])
+        values = value_ranges[0].get('values', []) if len(value_ranges) > 0 else []
+        message_values = value_ranges[1].get('values', []) if len(value_ranges) > 1 else []
+        processed_messages.seed(message_values[1:])
         
+        with self.lock:
+            self.counts.clear()
+            self.row_keys.clear()
+            for row_number, row in enumerate(values[1:], start=2):
+                key = self._row_key(row)
+                if key is not None:
+                    self._set_row(row_number, key)
+            self.last_row = max(len(values), 1)
+            self.loaded = True
+        log_info(f"[DUP] Индекс дубликатов загружен: {len(self.row_keys)} строк")
+    
+    def reconcile_tail(self, sheets, tail_rows=DUPLICATE_RECONCILE_TAIL_ROWS):
+        """Сверяет индекс с последними строками листа, не читая весь столбец"""
+        with self.lock:
+            known_last_row = self.last_row
+        start_row = max(2, known_last_row - tail_rows + 1)
+        
+        result = execute_request(sheets.values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f'{SHEET_NAME}!G{start_row}:I'
+        ), 'sheets', PRIORITY_BACKGROUND)
         values = result.get('values', [])
-        for row in values[1:]:
-            if len(row) >= 2:
-                row_tt = row[0].strip() if len(row) > 0 else ""
-                row_address = row[2].strip() if len(row) > 2 else ""
-                if row_tt == tt.strip() and row_address == address.strip():
-                    return True
-        return False
+        
+        changed = 0
+        with self.lock:
+            seen_last_row = start_row + len(values) - 1
+            for offset, row in enumerate(values):
+                row_number = start_row + offset
+                key = self._row_key(row)
+                if self.row_keys.get(row_number) != key:
+                    self._set_row(row_number, key)
+                    changed += 1
+            # Строки, которые были в индексе, но исчезли из листа
+            for row_number in range(seen_last_row + 1, known_last_row + 1):
+                if row_number in self.row_keys:
+                    self._set_row(row_number, None)
+                    changed += 1
+            self.last_row = max(seen_last_row, max(self.row_keys, default=1))
+        if changed:
+            log_info(f"[DUP] Сверка с листом: обновлено {changed} строк (с {start_row})")
+    
+    def check_and_reserve(self, tt, address):
+        """
+        O(1) проверка дубликата без обращения к API.
+        Ключ резервируется до окончания записи, чтобы параллельное
+        сообщение с теми же TT и адресом тоже считалось дубликатом.
+        """
+        key = self.make_key(tt, address)
+        with self.lock:
+            is_duplicate = self.counts[key] > 0 or self.pending[key] > 0
+            self.pending[key] += 1
+        return is_duplicate
+    
+    def release(self, tt, address):
+        key = self.make_key(tt, address)
+        with self.lock:
+            self.pending[key] -= 1
+            if self.pending[key] <= 0:
+                del self.pending[key]
+    
+    def add_row(self, row_number, tt, address):
+        with self.lock:
+            self._set_row(row_number, self.make_key(tt, address))
+            self.last_row = max(self.last_row, row_number)
+
+duplicate_index = DuplicateIndex()
+
+def check_for_duplicate(tt, address):
+    if not duplicate_index.loaded:
+        log_warn("[DUP] Индекс дубликатов еще не загружен")
+    return duplicate_index.check_and_reserve(tt, address)
+
+def load_duplicate_index(sheets):
+    try:
+        duplicate_index.load(sheets)
+        return True
     except Exception as e:
-        log_error(f"Ошибка проверки дубликатов: {e}")
+        log_error(f"Ошибка загрузки индекса дубликатов: {e}")
         return False
 
-def upload_photo_to_drive(photo_data, message_id):
-    try:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        drive_service = build('drive', 'v3', credentials=credentials)
-        
-        now = get_moscow_time()
-        folder_name = now.strftime("%d-%m-%Y")
+# ============ ИНДЕКС ЗАПИСАННЫХ СООБЩЕНИЙ ============
+class ProcessedMessageIndex:
+    """
+    Сообщения (CHAT_ID, MESSAGE_ID), по которым строка уже записана. Повтор события
+    после переподключения Telethon, догрузка или повтор заявки из очереди
+    пропускаются за O(1), без второй строки, ложного "Возврат" и повторной отметки МКД.
+    Засевается из столбцов N:O листа и из базы состояния, новые ключи сохраняются в базу.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.store = None
+    
+    @staticmethod
+    def make_key(chat_id, message_id):
+        try:
+            return (int(chat_id), int(message_id))
+        except (TypeError, ValueError):
+            return None
+    
+    def attach(self, store):
+        """Подключает базу состояния и загружает из нее сохраненные ключи"""
+        self.store = store
+        keys = store.load_processed()
+        with self.lock:
+            self.keys.update(keys)
+        log_info(f"[IDEMP] Записанных сообщений в базе: {len(keys)}")
+    
+    def seed(self, rows):
+        """Строки диапазона N:O листа (без заголовка)"""
+        keys = [self.make_key(*row[:2]) for row in rows if len(row) >= 2]
+        with self.lock:
+            before = len(self.keys)
+            self.keys.update(key for key in keys if key is not None)
+            added = len(self.keys) - before
+        log_info(f"[IDEMP] Индекс записанных сообщений: {len(self.keys)} (из листа добавлено {added})")
+    
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.keys
+    
+    def row_number(self, key):
+        """Номер строки из базы состояния (None, если ключ засеян из листа)"""
+        if self.store is None:
+            return None
+        return self.store.processed_row(*key)
+    
+    def add(self, chat_id, message_ids, row_number=None):
+        keys = [self.make_key(chat_id, message_id) for message_id in message_ids]
+        keys = [key for key in keys if key is not None]
+        with self.lock:
+            self.keys.update(keys)
+        if self.store is not None and keys:
+            self.store.save_processed(keys, row_number)
+
+processed_messages = ProcessedMessageIndex()
+
+async def duplicate_reconcile_loop():
+    """Периодически сверяет индекс дубликатов с хвостом листа"""
+    while True:
+        await asyncio.sleep(DUPLICATE_RECONCILE_INTERVAL)
+        try:
+            sheets = init_google_sheets()
+            if not sheets:
+                continue
+            if duplicate_index.loaded:
+                await run_blocking(duplicate_index.reconcile_tail, sheets)
+            else:
+                await run_blocking(load_duplicate_index, sheets)
+        except Exception as e:
+            log_error(f"Ошибка сверки индекса дубликатов: {e}")
+
+def get_daily_drive_folder(drive, folder_name):
+    """
+    ID папки дня в DRIVE_ROOT_FOLDER_ID. Ищется/создается один раз в сутки,
+    дальше берется из кэша. Под блокировкой, чтобы загрузки, совпавшие с полуночью,
+    не создали несколько папок. Папке один раз выдается доступ "всем по ссылке",
+    файлы внутри получают его по наследству.
+    """
+    folder_id = drive_folder_cache.get(folder_name)
+    if folder_id:
+        return folder_id
+    
+    with drive_folder_lock:
+        folder_id = drive_folder_cache.get(folder_name)
+        if folder_id:
+            return folder_id
         
         log_info(f"[INFO] Поиск папки: {folder_name}")
         
         query = f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and '{DRIVE_ROOT_FOLDER_ID}' in parents and trashed=false"
-        results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-        folders = results.get('files', [])
-        
-        if folders:
-            folder_id = folders[0]['id']
-            log_info(f"   [OK] Найдена папка")
-        else:
+        for attempt in range(DRIVE_CREATE_ATTEMPTS):
+            results = execute_request(drive.files().list(q=query, fields="files(id, name)"), 'drive')
+            folders = results.get('files', [])
+            
+            if folders:
+                folder_id = folders[0]['id']
+                log_info(f"   [OK] Найдена папка")
+                break
             file_metadata = {
                 'name': folder_name,
                 'mimeType': 'application/vnd.google-apps.folder',
                 'parents': [DRIVE_ROOT_FOLDER_ID]
             }
-            folder = drive_service.files().create(body=file_metadata, fields='id').execute()
+            try:
+                folder = execute_request(drive.files().create(body=file_metadata, fields='id'), 'drive', idempotent=False)
+            except Exception as e:
+                # Папка могла создаться: перед повтором она ищется заново
+                if attempt + 1 >= DRIVE_CREATE_ATTEMPTS or not _is_retryable_error(e):
+                    raise
+                log_warn(f"[DRIVE] Ошибка создания папки {folder_name}: {e}, проверяю и повторяю")
+                continue
             folder_id = folder.get('id')
             log_info(f"   [OK] Создана папка")
-        
-        file_name = now.strftime("%H%M") + ".jpg"
-        file_metadata = {
-            'name': file_name,
-            'parents': [folder_id]
-        }
-        
-        media = MediaIoBaseUpload(io.BytesIO(photo_data), mimetype='image/jpeg', resumable=True)
-        file = drive_service.files().create(
-            body=file_metadata, 
-            media_body=media, 
-            fields='id, webViewLink'
-        ).execute()
-        
-        file_id = file.get('id')
-        web_view_link = file.get('webViewLink')
+            break
         
         permission = {
             'type': 'anyone',
             'role': 'reader'
         }
-        drive_service.permissions().create(
-            fileId=file_id,
+        execute_request(drive.permissions().create(
+            fileId=folder_id,
             body=permission
-        ).execute()
+        ), 'drive')
         
-        log_info(f"   [OK] Файл загружен")
-        return web_view_link
+        # Папки прошлых дней больше не нужны
+        drive_folder_cache.clear()
+        drive_folder_cache[folder_name] = folder_id
+        return folder_id
+
+def _find_uploaded_photo(drive, folder_id, photo_hash):
+    """Файл в папке дня с тем же хэшем содержимого (appProperties.sha256) или None"""
+    query = (f"appProperties has {{ key='sha256' and value='{photo_hash}' }} "
+             f"and '{folder_id}' in parents and trashed=false")
+    results = execute_request(drive.files().list(q=query, fields="files(id, webViewLink)"), 'drive')
+    files = results.get('files', [])
+    return files[0] if files else None
+
+class PhotoUploadError(Exception):
+    """Фото не скачано из Telegram или не загружено в Drive, заявку нужно повторить"""
+
+def upload_photo_to_drive(photo_buffer, message_id, photo_hash=None):
+    """
+    Загружает фото из буфера в памяти в папку текущего дня на Drive, возвращает webViewLink.
+    files().create не идемпотентен: после таймаута или 5xx файл ищется по photo_hash
+    и загружается повторно, только если его нет.
+    Ошибки не глотаются: заявка повторяется из очереди, а не пишется без фото.
+    """
+    drive = get_drive_service()
+    if not drive:
+        raise PhotoUploadError("нет подключения к Google Drive")
+    _count_google_stat('builds_saved')
+    
+    now = get_moscow_time()
+    folder_id = get_daily_drive_folder(drive, now.strftime("%d-%m-%Y"))
+    
+    file_name = now.strftime("%H%M") + ".jpg"
+    file_metadata = {
+        'name': file_name,
+        'parents': [folder_id]
+    }
+    if photo_hash:
+        file_metadata['appProperties'] = {'sha256': photo_hash}
+    
+    # Небольшие фото уходят одним multipart-запросом, большие - по частям (resumable),
+    # чтобы не собирать в памяти еще одну полную копию
+    _import_google_modules()
+    photo_size = photo_buffer.seek(0, io.SEEK_END)
+    for attempt in range(DRIVE_CREATE_ATTEMPTS):
+        photo_buffer.seek(0)
+        media = MediaIoBaseUpload(
+            photo_buffer,
+            mimetype='image/jpeg',
+            chunksize=PHOTO_UPLOAD_CHUNK_SIZE,
+            resumable=photo_size > PHOTO_UPLOAD_CHUNK_SIZE
+        )
+        try:
+            file = execute_request(drive.files().create(
+                body=file_metadata, 
+                media_body=media, 
+                fields='id, webViewLink'
+            ), 'drive', idempotent=False)
+            break
+        except Exception as e:
+            if attempt + 1 >= DRIVE_CREATE_ATTEMPTS or not _is_retryable_error(e) or not photo_hash:
+                raise
+            file = None if _is_not_applied_error(e) else _find_uploaded_photo(drive, folder_id, photo_hash)
+            if file:
+                log_warn(f"[DRIVE] Загрузка завершилась ошибкой ({e}), но файл уже создан")
+                break
+            log_warn(f"[DRIVE] Фото не загружено ({e}), повторяю")
+    
+    # Доступ по ссылке файл наследует от папки дня, отдельный permissions().create не нужен
+    web_view_link = file.get('webViewLink')
+    
+    log_info(f"   [OK] Файл загружен")
+    return web_view_link
+
+class MemoryBudget:
+    """Ограничивает суммарный объем фото, одновременно находящихся в памяти"""
+    
+    def __init__(self, limit_bytes):
+        self.limit = limit_bytes
+        self.used = 0
+        self.condition = asyncio.Condition()
+    
+    @contextlib.asynccontextmanager
+    async def reserve(self, size):
+        # Фото больше лимита все равно обрабатывается, но только в одиночку
+        size = min(size, self.limit)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.used -= size
+                self.condition.notify_all()
+
+photo_memory_budget = MemoryBudget(PHOTO_MEMORY_LIMIT_MB * 1024 * 1024)
+
+def get_photo_size(message):
+    """Размер фото до скачивания (Telethon знает его из метаданных)"""
+    size = getattr(getattr(message, 'file', None), 'size', None)
+    return size or PHOTO_DEFAULT_SIZE
+
+# ============ ОЧЕРЕДЬ ВХОДЯЩИХ СООБЩЕНИЙ (SQLite) ============
+class IngestQueue:
+    """
+    Надежная локальная очередь входящих заявок в SQLite (режим WAL).
+    Сообщение записывается сразу после получения события, обрабатывают его
+    воркеры; при ошибках Google API заявка повторяется, а после перезапуска
+    незавершенные заявки снова становятся в очередь.
+    Ключ (chat_id, message_id) - повторное событие того же сообщения не добавится.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.wakeup = None
+        self.conn = None
+    
+    def open(self):
+        if self.conn is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ingest_queue (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                user_id INTEGER,
+                chat_title TEXT,
+                text TEXT,
+                has_photo INTEGER NOT NULL DEFAULT 0,
+                group_id INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                state TEXT,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        """)
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(ingest_queue)")}
+        if 'group_id' not in columns:
+            self.conn.execute("ALTER TABLE ingest_queue ADD COLUMN group_id INTEGER")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ingest_ready ON ingest_queue(status, next_attempt_at)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ingest_group ON ingest_queue(chat_id, group_id)"
+        )
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                row_number INTEGER,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (chat_id, message_id)
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS photo_hashes (
+                hash TEXT PRIMARY KEY,
+                link TEXT NOT NULL,
+                used_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_photo_hashes_used ON photo_hashes(used_at)"
+        )
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS mkd_pending (
+                row_number INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS chat_progress (
+                chat_id INTEGER PRIMARY KEY,
+                last_message_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        # Заявки, которые обрабатывались в момент остановки, начинаем заново
+        resumed = self.conn.execute(
+            "UPDATE ingest_queue SET status = 'pending' WHERE status = 'processing'"
+        ).rowcount
+        pending = self.depth()
+        log_info(f"[QUEUE] Очередь {self.path}: в ожидании {pending} (возобновлено {resumed})")
+    
+    def _notify(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+    
+    def enqueue(self, chat_id, message_id, user_id, chat_title, text, has_photo, group_id=None, delay=0):
+        """
+        Добавляет заявку, возвращает False, если это сообщение уже было в очереди.
+        Сообщения с одним group_id (альбом) обрабатываются вместе, не раньше чем через delay секунд.
+        """
+        now = time.time()
+        with self.lock:
+            inserted = self.conn.execute(
+                """INSERT OR IGNORE INTO ingest_queue
+                   (chat_id, message_id, user_id, chat_title, text, has_photo, group_id,
+                    next_attempt_at, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (chat_id, message_id, user_id, chat_title, text, int(bool(has_photo)), group_id,
+                 now + delay, now, now)
+            ).rowcount
+        if inserted:
+            self._notify()
+        return bool(inserted)
+    
+    def claim(self):
+        """
+        Берет в работу самую старую готовую заявку (или None). Для альбома
+        забираются все его сообщения: job['members'] - строки по порядку,
+        message_id и поля заявки - от первого сообщения, подпись - первая непустая.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                """SELECT * FROM ingest_queue
+                   WHERE status = 'pending' AND next_attempt_at <= ?
+                   ORDER BY created_at LIMIT 1""",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row['group_id'] is None:
+                members = [row]
+            else:
+                members = self.conn.execute(
+                    """SELECT * FROM ingest_queue
+                       WHERE chat_id = ? AND group_id = ? AND status = 'pending'
+                       ORDER BY message_id""",
+                    (row['chat_id'], row['group_id'])
+                ).fetchall()
+            message_ids = [member['message_id'] for member in members]
+            self.conn.execute(
+                f"""UPDATE ingest_queue SET status = 'processing', attempts = attempts + 1, updated_at = ?
+                    WHERE chat_id = ? AND message_id IN ({','.join('?' * len(message_ids))})""",
+                (now, row['chat_id'], *message_ids)
+            )
+        members = [dict(member) for member in members]
+        job = dict(members[0])
+        job['members'] = members
+        job['message_ids'] = message_ids
+        job['text'] = next((member['text'] for member in members if member['text']), "")
+        job['has_photo'] = any(member['has_photo'] for member in members)
+        job['attempts'] = max(member['attempts'] for member in members) + 1
+        state = next((member['state'] for member in members if member['state']), None)
+        job['state'] = json.loads(state) if state else {}
+        return job
+    
+    def _update(self, job, status=None, **fields):
+        if status is not None:
+            fields['status'] = status
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        message_ids = job['message_ids']
+        with self.lock:
+            self.conn.execute(
+                f"""UPDATE ingest_queue SET {assignments}
+                    WHERE chat_id = ? AND message_id IN ({','.join('?' * len(message_ids))})""",
+                (*fields.values(), job['chat_id'], *message_ids)
+            )
+    
+    def save_state(self, job):
+        """Сохраняет результаты пройденных стадий, чтобы повтор их не выполнял"""
+        self._update(job, state=json.dumps(job['state'], ensure_ascii=False))
+    
+    def complete(self, job):
+        self._update(job, 'done', last_error=None)
+    
+    def retry(self, job, error, delay):
+        self._update(job, 'pending', last_error=str(error), next_attempt_at=time.time() + delay)
+        self._notify()
+    
+    def fail(self, job, error):
+        self._update(job, 'failed', last_error=str(error))
+    
+    def depth(self):
+        """Число заявок, ожидающих или находящихся в обработке"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM ingest_queue WHERE status IN ('pending', 'processing')"
+            ).fetchone()[0]
+    
+    def next_attempt_delay(self):
+        """Сколько секунд до ближайшей отложенной заявки (None, если таких нет)"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT MIN(next_attempt_at) FROM ingest_queue WHERE status = 'pending'"
+            ).fetchone()
+        if row[0] is None:
+            return None
+        return max(0.0, row[0] - time.time())
+    
+    def save_processed(self, keys, row_number=None):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed_messages (chat_id, message_id, row_number, created_at) VALUES (?, ?, ?, ?)",
+                [(chat_id, message_id, row_number, now) for chat_id, message_id in keys]
+            )
+    
+    def load_processed(self):
+        with self.lock:
+            return [tuple(row) for row in self.conn.execute("SELECT chat_id, message_id FROM processed_messages")]
+    
+    def processed_row(self, chat_id, message_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT row_number FROM processed_messages WHERE chat_id = ? AND message_id = ?",
+                (chat_id, message_id)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def save_photo_hash(self, photo_hash, link):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO photo_hashes (hash, link, used_at) VALUES (?, ?, ?)",
+                (photo_hash, link, time.time())
+            )
+    
+    def touch_photo_hash(self, photo_hash):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE photo_hashes SET used_at = ? WHERE hash = ?", (time.time(), photo_hash)
+            )
+    
+    def load_photo_hashes(self, limit):
+        """Последние limit хэшей, от давно использованных к недавним"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT hash, link FROM photo_hashes ORDER BY used_at DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [tuple(row) for row in reversed(rows)]
+    
+    def prune_photo_hashes(self, keep):
+        """Оставляет keep последних использованных хэшей"""
+        with self.lock:
+            return self.conn.execute(
+                """DELETE FROM photo_hashes WHERE hash NOT IN
+                   (SELECT hash FROM photo_hashes ORDER BY used_at DESC LIMIT ?)""",
+                (keep,)
+            ).rowcount
+    
+    def save_mkd_pending(self, row_number):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO mkd_pending (row_number, created_at) VALUES (?, ?)",
+                (row_number, time.time())
+            )
+    
+    def delete_mkd_pending(self, row_numbers):
+        with self.lock:
+            self.conn.executemany(
+                "DELETE FROM mkd_pending WHERE row_number = ?", [(row_number,) for row_number in row_numbers]
+            )
+    
+    def load_mkd_pending(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT row_number FROM mkd_pending")]
+    
+    def mark_seen(self, chat_id, message_id):
+        """Запоминает последнее обработанное сообщение чата (для догрузки после перезапуска)"""
+        with self.lock:
+            self.conn.execute(
+                """INSERT INTO chat_progress (chat_id, last_message_id, updated_at) VALUES (?, ?, ?)
+                   ON CONFLICT(chat_id) DO UPDATE SET
+                       last_message_id = MAX(last_message_id, excluded.last_message_id),
+                       updated_at = excluded.updated_at""",
+                (chat_id, message_id, time.time())
+            )
+    
+    def last_message_id(self, chat_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_message_id FROM chat_progress WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def prune(self, max_age_seconds):
+        """Удаляет завершенные заявки старше max_age_seconds"""
+        with self.lock:
+            return self.conn.execute(
+                "DELETE FROM ingest_queue WHERE status = 'done' AND updated_at < ?",
+                (time.time() - max_age_seconds,)
+            ).rowcount
+
+ingest_queue = IngestQueue(STATE_DB_PATH)
+
+# ============ ЛОКАЛЬНАЯ КОПИЯ ЛИСТА ЗАЯВОК (SQLite) ============
+TICKET_MIRROR_COLUMNS = [name.lower() for name in sorted(COL, key=COL.get)]  # A-S
+
+class TicketMirror:
+    """
+    Копия столбцов A-S основного листа в SQLite с индексами по округу, дате и TT.
+    Строки, которые пишет бот, попадают сюда сразу, остальное приносит сверка
+    с листом (sync). Запросы /tickets и /stats не тратят квоту Sheets.
+    Копию можно удалить в любой момент: при пустой базе сверка загрузит весь лист.
+    """
+    
+    # Открытая заявка: нет даты закрытия (D) и не стоит флажок (A)
+    OPEN_CONDITION = "date_closed = '' AND checkbox != 'TRUE'"
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.row_count = 0
+    
+    def open(self):
+        if self.conn is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(f"{name} TEXT NOT NULL DEFAULT ''" for name in TICKET_MIRROR_COLUMNS)
+        self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS tickets (
+                row_number INTEGER PRIMARY KEY,
+                {columns},
+                opened_on TEXT,
+                synced_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_district ON tickets(district, opened_on)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_opened ON tickets(opened_on)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_tickets_tt ON tickets(tt)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS mirror_state (
+                name TEXT PRIMARY KEY,
+                value REAL NOT NULL
+            )
+        """)
+        self.row_count = self.conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+        log_info(f"[MIRROR] Копия листа {self.path}: {self.row_count} строк")
+    
+    @staticmethod
+    def iso_date(value):
+        """ДД.ММ.ГГГГ (как пишет бот) или ГГГГ-ММ-ДД -> ГГГГ-ММ-ДД, иначе None"""
+        for date_format in ("%d.%m.%Y", "%Y-%m-%d"):
+            try:
+                return datetime.strptime(value.strip(), date_format).strftime("%Y-%m-%d")
+            except ValueError:
+                continue
+        return None
+    
+    # Флажки (A, L) в таблице с русской локалью читаются как ИСТИНА/ЛОЖЬ
+    CHECKBOX_VALUES = {'TRUE': 'TRUE', 'ИСТИНА': 'TRUE', 'FALSE': 'FALSE', 'ЛОЖЬ': 'FALSE'}
+    
+    def _record(self, row_number, row, now):
+        values = [str(value) for value in row[:len(TICKET_MIRROR_COLUMNS)]]
+        values += [''] * (len(TICKET_MIRROR_COLUMNS) - len(values))
+        for column in ('CHECKBOX', 'DELETE_FLAG'):
+            value = values[COL[column]-1]
+            values[COL[column]-1] = self.CHECKBOX_VALUES.get(value.strip().upper(), value)
+        return (row_number, *values, self.iso_date(values[COL['DATE_OPENED']-1]), now)
+    
+    def _write_records(self, records):
+        placeholders = ', '.join('?' * (len(TICKET_MIRROR_COLUMNS) + 3))
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    f"""INSERT OR REPLACE INTO tickets
+                        (row_number, {', '.join(TICKET_MIRROR_COLUMNS)}, opened_on, synced_at)
+                        VALUES ({placeholders})""",
+                    records
+                )
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            self.row_count = self.conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+    
+    def upsert(self, rows):
+        """Строки, записанные ботом: пары (номер строки, значения A-S)"""
+        if self.conn is None:
+            return
+        now = time.time()
+        self._write_records([self._record(row_number, row, now) for row_number, row in rows])
+    
+    def _get_state(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM mirror_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+    
+    def _set_state(self, name, value):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO mirror_state (name, value) VALUES (?, ?)", (name, value))
+    
+    def sync(self, sheets):
+        """
+        Сверка с листом: весь лист, если копия пуста или полная сверка была давно,
+        иначе последние TICKET_MIRROR_TAIL_ROWS строк (новые строки и недавние правки).
+        Из копии удаляются строки после последней прочитанной, но только известные
+        до чтения: строки, которые бот дописал во время чтения, остаются.
+        """
+        last_full_sync = self._get_state('last_full_sync')
+        full = (not self.row_count or last_full_sync is None
+                or time.time() - last_full_sync >= TICKET_MIRROR_FULL_SYNC_INTERVAL)
+        with self.lock:
+            known_last_row = self.conn.execute("SELECT MAX(row_number) FROM tickets").fetchone()[0] or 1
+        start_row = 2 if full else max(2, known_last_row - TICKET_MIRROR_TAIL_ROWS + 1)
         
-    except Exception as e:
-        log_error(f"Ошибка загрузки в Drive: {e}")
+        started = time.perf_counter()
+        result = execute_request(sheets.values().get(
+            spreadsheetId=SPREADSHEET_ID,
+            range=f'{SHEET_NAME}!A{start_row}:S'
+        ), 'sheets', PRIORITY_MAINTENANCE)
+        values = result.get('values', [])
+        
+        now = time.time()
+        # Пачками: запросы /tickets не ждут всю полную сверку
+        for offset in range(0, len(values), TICKET_MIRROR_BATCH_SIZE):
+            chunk = values[offset:offset + TICKET_MIRROR_BATCH_SIZE]
+            self._write_records([self._record(start_row + offset + i, row, now) for i, row in enumerate(chunk)])
+        with self.lock:
+            removed = self.conn.execute(
+                "DELETE FROM tickets WHERE row_number >= ? AND row_number <= ?",
+                (start_row + len(values), known_last_row)
+            ).rowcount
+            self.row_count = self.conn.execute("SELECT COUNT(*) FROM tickets").fetchone()[0]
+        
+        self._set_state('last_sync', now)
+        if full:
+            self._set_state('last_full_sync', now)
+        log_info(f"[MIRROR] {'Полная сверка' if full else 'Сверка хвоста'} с листом (с {start_row}): "
+                 f"{len(values)} строк, удалено {removed}, {time.perf_counter() - started:.1f} с")
+    
+    @classmethod
+    def _where(cls, district=None, tt=None, status=None, date_from=None, date_to=None, open_only=None):
+        # Строки с отметкой удаления (L) не учитываются
+        conditions = ["delete_flag != 'TRUE'"]
+        params = []
+        for column, value in (('district', district), ('tt', tt), ('status', status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value.strip())
+        if date_from is not None:
+            conditions.append("opened_on >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append("opened_on <= ?")
+            params.append(date_to)
+        if open_only is not None:
+            conditions.append(f"({cls.OPEN_CONDITION})" if open_only else f"NOT ({cls.OPEN_CONDITION})")
+        return " AND ".join(conditions), params
+    
+    def query_tickets(self, limit=TICKETS_DEFAULT_LIMIT, offset=0, **filters):
+        """(всего подходящих, строки страницы) - новые первыми"""
+        where, params = self._where(**filters)
+        with self.lock:
+            total = self.conn.execute(f"SELECT COUNT(*) FROM tickets WHERE {where}", params).fetchone()[0]
+            rows = self.conn.execute(
+                f"""SELECT row_number, {', '.join(TICKET_MIRROR_COLUMNS)} FROM tickets WHERE {where}
+                    ORDER BY row_number DESC LIMIT ? OFFSET ?""",
+                (*params, limit, offset)
+            ).fetchall()
+        return total, [dict(row) for row in rows]
+    
+    def stats(self, **filters):
+        where, params = self._where(**filters)
+        is_open = f"CASE WHEN {self.OPEN_CONDITION} THEN 1 ELSE 0 END"
+        with self.lock:
+            total, open_count = self.conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM({is_open}), 0) FROM tickets WHERE {where}", params
+            ).fetchone()
+            by_district = self.conn.execute(
+                f"SELECT district, COUNT(*), SUM({is_open}) FROM tickets WHERE {where} GROUP BY district", params
+            ).fetchall()
+            by_status = self.conn.execute(
+                f"SELECT status, COUNT(*) FROM tickets WHERE {where} GROUP BY status", params
+            ).fetchall()
+        return {
+            'total': total,
+            'open': open_count,
+            'by_district': {district: {'total': count, 'open': opened} for district, count, opened in by_district},
+            'by_status': {status: count for status, count in by_status},
+            'mirror': {
+                'rows': self.row_count,
+                'last_sync': self._get_state('last_sync'),
+                'last_full_sync': self._get_state('last_full_sync'),
+            },
+        }
+
+ticket_mirror = TicketMirror(TICKET_MIRROR_PATH)
+
+async def ticket_mirror_sync_loop():
+    """Сверяет копию листа сразу после запуска и дальше каждые TICKET_MIRROR_SYNC_INTERVAL секунд"""
+    while True:
+        try:
+            sheets = init_google_sheets()
+            if sheets:
+                await run_blocking(ticket_mirror.sync, sheets)
+        except Exception as e:
+            log_error(f"[MIRROR] Ошибка сверки копии листа: {e}")
+        await asyncio.sleep(TICKET_MIRROR_SYNC_INTERVAL)
+
+# ============ ИНДЕКС ФОТО ПО СОДЕРЖИМОМУ ============
+class PhotoHashIndex:
+    """
+    sha256 содержимого фото -> webViewLink уже загруженного файла. Одно и то же фото,
+    пересланное в несколько чатов или присланное повторно с "Возврат", не загружается
+    в Drive второй раз. Хранит limit последних использованных хэшей (LRU), копия - в базе состояния.
+    """
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.links = OrderedDict()
+        self.store = None
+        # Загрузки, которые идут прямо сейчас: одинаковые фото из разных чатов ждут первую
+        self.in_flight = {}
+    
+    @staticmethod
+    def hash_photo(photo_buffer):
+        return hashlib.sha256(photo_buffer.getbuffer()).hexdigest()
+    
+    def attach(self, store):
+        """Подключает базу состояния и загружает из нее последние хэши"""
+        self.store = store
+        rows = store.load_photo_hashes(self.limit)
+        with self.lock:
+            for photo_hash, link in rows:
+                self.links[photo_hash] = link
+        log_info(f"[PHOTO] Хэшей загруженных фото в базе: {len(rows)}")
+    
+    def get(self, photo_hash):
+        with self.lock:
+            link = self.links.get(photo_hash)
+            if link is not None:
+                self.links.move_to_end(photo_hash)
+        if link is not None and self.store is not None:
+            self.store.touch_photo_hash(photo_hash)
+        return link
+    
+    def add(self, photo_hash, link):
+        with self.lock:
+            self.links[photo_hash] = link
+            self.links.move_to_end(photo_hash)
+            while len(self.links) > self.limit:
+                self.links.popitem(last=False)
+        if self.store is not None:
+            self.store.save_photo_hash(photo_hash, link)
+    
+    def prune(self):
+        """Удаляет из базы хэши, вытесненные из LRU"""
+        if self.store is None:
+            return 0
+        return self.store.prune_photo_hashes(self.limit)
+
+photo_hashes = PhotoHashIndex(PHOTO_HASH_CACHE_SIZE)
+
+# ============ СТРОКА ЗАЯВКИ ============
+def build_ticket_row(chat_id, message_id, user_id, tt, address, district, photo_link, is_duplicate):
+    current_date = get_moscow_date_str()
+    current_time = get_moscow_time_str()
+    
+    row_data = [''] * 19  # Увеличиваем до 19 колонок (A-S)
+    row_data[COL['DATE_OPENED']-1] = current_date
+    row_data[COL['TIME_OPENED']-1] = current_time
+    row_data[COL['TT']-1] = tt
+    row_data[COL['DISTRICT']-1] = district
+    row_data[COL['ADDRESS']-1] = address
+    row_data[COL['CHAT_ID']-1] = str(chat_id)
+    row_data[COL['MESSAGE_ID']-1] = str(message_id)
+    row_data[COL['PHOTO_URL']-1] = photo_link
+    row_data[COL['USER_ID']-1] = str(user_id)
+    
+    if is_duplicate:
+        row_data[COL['STATUS']-1] = "Возврат"
+        row_data[COL['ORIGINAL_STATUS']-1] = "Возврат"
+    return row_data
+
+# ============ СТАДИИ ОБРАБОТКИ ЗАЯВКИ ============
+# Стадии не зависят друг от друга до записи строки, поэтому идут параллельно,
+# и задержка заявки равна самой долгой стадии, а не их сумме:
+#
+#   загрузка фото  ──┐
+#   проверка дубля ──┼──> запись строки ──> подтверждение
+#   поиск в МКД    ──┘
+async def stage_upload_photo(message):
+    """
+    Скачивает фото в память и загружает в Drive, возвращает ссылку ("" для текста).
+    Если фото не удалось скачать или загрузить, бросает исключение.
+    """
+    if message is None or not message.photo:
         return ""
+    # Фото скачивается сразу в память (без временного файла) и из того же
+    # буфера уходит в Drive; общий объем фото в памяти ограничен
+    drive_file_url = ""
+    async with photo_memory_budget.reserve(get_photo_size(message)):
+        photo_buffer = io.BytesIO()
+        with metrics.timer('bot_stage_duration_seconds', stage='download'):
+            downloaded = await message.download_media(file=photo_buffer)
+        if downloaded:
+            log_info(f"   [INFO] Фото скачано, размер: {photo_buffer.tell()} байт")
+            drive_file_url = await upload_photo_deduplicated(photo_buffer, message.id)
+        else:
+            raise PhotoUploadError(f"не удалось скачать фото {message.id}")
+        del photo_buffer
+    return drive_file_url
+
+async def upload_photo_deduplicated(photo_buffer, message_id):
+    """Загружает фото в Drive, если такого же по содержимому еще не загружали, иначе возвращает прежнюю ссылку"""
+    photo_hash = await run_blocking(PhotoHashIndex.hash_photo, photo_buffer, executor=local_executor)
+    # Между проверкой и регистрацией своей загрузки нет await,
+    # иначе два одинаковых фото загрузятся оба
+    while photo_hash in photo_hashes.in_flight:
+        link = await asyncio.shield(photo_hashes.in_flight[photo_hash])
+        if link:
+            metrics.inc('bot_photo_uploads_total', result='reused')
+            log_info("   [OK] Такое же фото только что загружено, ссылка переиспользована")
+            return link
+    link = photo_hashes.get(photo_hash)
+    if link:
+        metrics.inc('bot_photo_uploads_total', result='reused')
+        log_info("   [OK] Такое же фото уже загружено, ссылка переиспользована")
+        return link
+    
+    future = asyncio.get_running_loop().create_future()
+    photo_hashes.in_flight[photo_hash] = future
+    link = ""
+    try:
+        # У воркеров общий индекс хэшей в процессе записи: фото, пересланное
+        # в чат другого воркера, тоже не загружается второй раз
+        if writer_client is not None:
+            link = await writer_client.photo_link(photo_hash) or ""
+            if link:
+                metrics.inc('bot_photo_uploads_total', result='reused')
+                log_info("   [OK] Такое же фото загружено другим воркером, ссылка переиспользована")
+                await run_blocking(photo_hashes.add, photo_hash, link, executor=local_executor)
+                return link
+        with metrics.timer('bot_stage_duration_seconds', stage='drive_upload'):
+            if writer_client is not None:
+                await writer_client.prefetch_drive_folder()
+            link = await run_blocking(upload_photo_to_drive, photo_buffer, message_id, photo_hash)
+        if link:
+            metrics.inc('bot_photo_uploads_total', result='uploaded')
+            await run_blocking(photo_hashes.add, photo_hash, link, executor=local_executor)
+            if writer_client is not None:
+                await writer_client.save_photo_link(photo_hash, link)
+    finally:
+        del photo_hashes.in_flight[photo_hash]
+        future.set_result(link)
+    return link
+
+async def stage_upload_photos(messages, final_attempt=False):
+    """
+    Фото заявки (альбома) загружаются параллельно, ссылки - через перевод строки.
+    Ошибка любого фото повторяет заявку (загруженные фото при повторе берутся по хэшу);
+    только на последней попытке строка пишется без незагруженных фото.
+    """
+    links = await asyncio.gather(*(stage_upload_photo(message) for message in messages), return_exceptions=True)
+    errors = [link for link in links if isinstance(link, BaseException)]
+    if errors:
+        if not final_attempt:
+            raise errors[0]
+        metrics.inc('bot_photo_uploads_total', len(errors), result='lost')
+        log_error(f"[PHOTO] {len(errors)} из {len(links)} фото не загружены за {INGEST_MAX_ATTEMPTS} попыток "
+                  f"({errors[0]}), заявка записывается без них")
+    return "\n".join(link for link in links if link and not isinstance(link, BaseException))
+
+async def stage_check_duplicate(tt, address):
+    with metrics.timer('bot_stage_duration_seconds', stage='duplicate_check'):
+        return check_for_duplicate(tt, address)
+
+async def stage_match_mkd(address):
+    # Проверяем наличие адреса в МКД и ставим отметку в очередь
+    with metrics.timer('bot_stage_duration_seconds', stage='mkd_match'):
+        return check_and_mark_address_in_mkd(address)
+
+class TicketWriteError(Exception):
+    """Строку заявки не удалось записать в таблицу, заявку нужно повторить"""
+
+class TicketAlreadyWritten(Exception):
+    """Процесс записи уже записал строку этого сообщения: заявка не пишется и не подтверждается повторно"""
+    
+    def __init__(self, row_number):
+        super().__init__(f"строка уже записана ({row_number})")
+        self.row_number = row_number
+
+async def process_ticket(messages, chat_id, message_id, user_id, chat_title, tt, address, state=None, save_state=None,
+                         final_attempt=False):
+    """
+    Обрабатывает заявку. messages - сообщения с фото (несколько для альбома), state - результаты уже пройденных стадий (при повторе
+    они не выполняются заново), save_state() сохраняет его перед записью строки.
+    final_attempt - последняя попытка из очереди: незагруженные фото больше не повторяются.
+    Возвращает номер строки или бросает исключение, если заявку нужно повторить.
+    """
+    state = {} if state is None else state
+    # Раньше на каждую заявку собирался свой клиент Sheets
+    _count_google_stat('builds_saved')
+    district = extract_district(address)
+    
+    stages = {}
+    if 'photo_link' not in state:
+        stages['photo_link'] = stage_upload_photos(messages, final_attempt)
+    # У воркера (BOT_ROLE=worker) дубликат и МКД проверяет процесс записи вместе с записью строки
+    if writer_client is None and 'is_duplicate' not in state:
+        stages['is_duplicate'] = stage_check_duplicate(tt, address)
+    if writer_client is None and 'mkd' not in state:
+        stages['mkd'] = stage_match_mkd(address)
+    results = dict(zip(stages, await asyncio.gather(*stages.values(), return_exceptions=True)))
+    
+    # Проверка дубликата резервирует ключ - снимаем резерв в любом случае
+    reserved = 'is_duplicate' in results and not isinstance(results['is_duplicate'], BaseException)
+    try:
+        errors = [result for result in results.values() if isinstance(result, BaseException)]
+        state.update((name, result) for name, result in results.items() if not isinstance(result, BaseException))
+        if results and save_state:
+            save_state()
+        if errors:
+            raise errors[0]
+        
+        with metrics.timer('bot_stage_duration_seconds', stage='sheet_write'):
+            if writer_client is not None:
+                row_number = await writer_client.write_ticket(
+                    chat_id, message_id, user_id, tt, address, district, state, save_state
+                )
+            else:
+                row_data = build_ticket_row(chat_id, message_id, user_id, tt, address, district,
+                                            state['photo_link'], state['is_duplicate'])
+                row_number = await sheet_writer.write(row_data, state['is_duplicate'], state['mkd'][0])
+        if row_number is None:
+            raise TicketWriteError("строка не записана в Google Sheets")
+    finally:
+        if reserved:
+            duplicate_index.release(tt, address)
+    
+    drive_file_url = state['photo_link']
+    is_duplicate = state['is_duplicate']
+    mkd_found, mkd_address = state['mkd']
+    send_confirmation(user_id, tt, address, district, drive_file_url, is_duplicate, chat_title, mkd_found, mkd_address)
+    return row_number
+
+async def get_job_messages(job):
+    """Сообщения Telethon с фото для заявки: из памяти или заново из Telegram (после перезапуска)"""
+    photo_ids = [member['message_id'] for member in job['members'] if member['has_photo']]
+    messages = {message_id: live_messages.get((job['chat_id'], message_id)) for message_id in photo_ids}
+    missing = [message_id for message_id, message in messages.items() if message is None]
+    if missing:
+        fetched = await bot_client.get_messages(job['chat_id'], ids=missing)
+        messages.update(zip(missing, fetched))
+    return [message for message in messages.values() if message is not None and message.photo]
+
+def forget_job_messages(job):
+    for message_id in job['message_ids']:
+        live_messages.pop((job['chat_id'], message_id), None)
+
+async def process_ingest_job(job):
+    key = (job['chat_id'], job['message_id'])
+    if key in processed_messages or (writer_client is not None and await writer_client.is_processed(*key)):
+        # Строка уже записана (например, процесс остановился до отметки в очереди)
+        log_info(f"[IDEMP] Заявка {key} уже записана в таблицу, пропускаю")
+        ingest_queue.complete(job)
+        forget_job_messages(job)
+        metrics.inc('bot_ingest_jobs_total', result='skipped')
+        return
+    try:
+        tt, address = parse_message_caption(job['text'] or "")
+        if not tt or not address:
+            # Альбом, ни в одной подписи которого нет TT и адреса
+            metrics.inc('bot_messages_total', type='invalid')
+            send_telegram_message(job['user_id'], "Ошибка: Не хватает данных в подписи", parse_mode=None)
+            ingest_queue.fail(job, "нет данных в подписи")
+            forget_job_messages(job)
+            return
+        messages = await get_job_messages(job)
+        await process_ticket(
+            messages, job['chat_id'], job['message_id'], job['user_id'], job['chat_title'], tt, address,
+            state=job['state'], save_state=lambda: ingest_queue.save_state(job),
+            final_attempt=job['attempts'] >= INGEST_MAX_ATTEMPTS
+        )
+        # Остальные сообщения альбома тоже считаются записанными
+        processed_messages.add(job['chat_id'], job['message_ids'])
+        ingest_queue.complete(job)
+        forget_job_messages(job)
+        metrics.inc('bot_ingest_jobs_total', result='done')
+    except TicketAlreadyWritten as e:
+        # Повтор после обрыва связи с процессом записи: первая попытка уже дошла
+        log_info(f"[IDEMP] Заявка {key} уже записана процессом записи (строка {e.row_number}), пропускаю")
+        processed_messages.add(job['chat_id'], job['message_ids'])
+        ingest_queue.complete(job)
+        forget_job_messages(job)
+        metrics.inc('bot_ingest_jobs_total', result='skipped')
+    except Exception as e:
+        if job['attempts'] >= INGEST_MAX_ATTEMPTS:
+            metrics.inc('bot_ingest_jobs_total', result='failed')
+            log_error(f"[QUEUE] Заявка {key} не обработана после {job['attempts']} попыток: {e}")
+            ingest_queue.fail(job, e)
+            forget_job_messages(job)
+        else:
+            metrics.inc('bot_ingest_jobs_total', result='retry')
+            delay = min(INGEST_RETRY_MAX_DELAY, INGEST_RETRY_BASE_DELAY * 2 ** (job['attempts'] - 1))
+            log_warn(f"[QUEUE] Заявка {key}: {e}. Повтор через {delay:.0f} с (попытка {job['attempts']})")
+            ingest_queue.retry(job, e, delay)
+
+async def ingest_worker():
+    """Воркер очереди: берет готовые заявки, пока они есть, иначе ждет новых"""
+    while True:
+        job = ingest_queue.claim()
+        if job is None:
+            delay = ingest_queue.next_attempt_delay()
+            timeout = INGEST_POLL_INTERVAL if delay is None else min(delay, INGEST_POLL_INTERVAL)
+            try:
+                await asyncio.wait_for(ingest_queue.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            ingest_queue.wakeup.clear()
+            continue
+        await process_ingest_job(job)
+
+async def ingest_maintenance_loop():
+    """Раз в сутки удаляет из очереди давно завершенные заявки и вытесненные хэши фото"""
+    while True:
+        try:
+            removed = ingest_queue.prune(INGEST_RETENTION_DAYS * 86400)
+            if removed:
+                log_info(f"[QUEUE] Удалено завершенных заявок: {removed}")
+            removed = photo_hashes.prune()
+            if removed:
+                log_info(f"[PHOTO] Удалено старых хэшей фото: {removed}")
+        except Exception as e:
+            log_error(f"[QUEUE] Ошибка очистки очереди: {e}")
+        await asyncio.sleep(86400)
+
+def start_ingest_workers():
+    ingest_queue.wakeup = asyncio.Event()
+    for _ in range(INGEST_WORKERS):
+        start_background_task(ingest_worker())
+    start_background_task(ingest_maintenance_loop())
 
 # ============ ОБРАБОТЧИК СООБЩЕНИЙ ============
+def remember_handled_message(key):
+    """False, если сообщение уже обрабатывалось (живое событие и догрузка могут пересечься)"""
+    if key in handled_messages:
+        return False
+    handled_messages[key] = True
+    if len(handled_messages) > HANDLED_MESSAGES_LIMIT:
+        handled_messages.popitem(last=False)
+    return True
+
 async def message_handler(event):
+    """Проверяет сообщение и сразу сохраняет заявку в очередь, обработка идет в воркерах"""
+    key = (event.chat_id, event.message.id)
+    if not remember_handled_message(key):
+        return
+    if key in processed_messages:
+        log_info(f"[IDEMP] Сообщение {key} уже записано в таблицу, пропускаю")
+        ingest_queue.mark_seen(*key)
+        return
+    try:
+        await handle_message(event)
+    except BaseException:
+        handled_messages.pop(key, None)
+        raise
+    # Отмечаем только после успешной обработки: иначе догрузка повторит сообщение
+    ingest_queue.mark_seen(*key)
+
+async def handle_message(event):
     message = event.message
     sender = await event.get_sender()
     chat = await event.get_chat()
     
     user_id = sender.id
     chat_id = event.chat_id
-    message_id = message.id
     chat_title = getattr(chat, 'title', f'Чат {chat_id}')
     display_name = get_user_display_name(sender)
     
     log_info(f"\n{'='*60}")
     log_info(f"[IN] Сообщение из '{chat_title}' от {display_name}")
     
-    sheets = init_google_sheets()
-    if not sheets:
-        log_error("Нет подключения к Google Sheets")
-        return
+    group_id = getattr(message, 'grouped_id', None)
+    
+    # Часть альбома: подпись обычно есть только у одного фото, поэтому
+    # сообщения копятся ALBUM_GROUP_WINDOW секунд и проверяются воркером вместе
+    if group_id:
+        caption = message.text or ""
+        log_info(f"[ALBUM] Альбом {group_id}, подпись: {caption[:100] or '(нет)'}")
+        metrics.inc('bot_messages_total', type='album')
+    
+    # Фото (подпись к фото Telethon отдает в message.text)
+    elif message.photo:
+        caption = message.text or "(Без подписи)"
+        log_info(f"[PHOTO] Подпись: {caption[:100]}")
+        error_msg = "Ошибка: Не хватает данных в подписи"
     
     # Текстовое сообщение
-    if message.text:
+    elif message.text:
         caption = message.text
         log_info(f"[TEXT] {caption[:100]}")
-        
-        tt, address = parse_message_caption(caption)
-        
-        if not tt or not address:
-            error_msg = "Ошибка: Не хватает данных.\n1 строка - TT\n2 строка - Адрес"
-            send_telegram_message(user_id, error_msg, parse_mode=None)
-            return
-        
-        district = extract_district(address)
-        is_duplicate = check_for_duplicate(sheets, tt, address)
-        
-        # Проверяем наличие адреса в МКД и обновляем статус
-        mkd_found, mkd_address = check_and_mark_address_in_mkd(sheets, address)
-        
-        current_date = get_moscow_date_str()
-        current_time = get_moscow_time_str()
-        
-        row_data = [''] * 19  # Увеличиваем до 19 колонок (A-S)
-        row_data[COL['DATE_OPENED']-1] = current_date
-        row_data[COL['TIME_OPENED']-1] = current_time
-        row_data[COL['TT']-1] = tt
-        row_data[COL['DISTRICT']-1] = district
-        row_data[COL['ADDRESS']-1] = address
-        row_data[COL['CHAT_ID']-1] = str(chat_id)
-        row_data[COL['MESSAGE_ID']-1] = str(message_id)
-        row_data[COL['USER_ID']-1] = str(user_id)
-        
-        if is_duplicate:
-            row_data[COL['STATUS']-1] = "Возврат"
-            row_data[COL['ORIGINAL_STATUS']-1] = "Возврат"
-        
-        # Записываем в таблицу
-        write_to_google_sheets(sheets, row_data, is_duplicate, mkd_found)
-        send_confirmation(user_id, tt, address, district, "", is_duplicate, chat_title, mkd_found, mkd_address)
+        error_msg = "Ошибка: Не хватает данных.\n1 строка - TT\n2 строка - Адрес"
     
-    # Фото
-    elif message.photo:
-        caption = message.caption or "(Без подписи)"
-        log_info(f"[PHOTO] Подпись: {caption[:100]}")
-        
+    else:
+        log_info("[INFO] Другой тип сообщения")
+        return
+    
+    if not group_id:
         tt, address = parse_message_caption(caption)
         
         if not tt or not address:
-            error_msg = "Ошибка: Не хватает данных в подписи"
+            metrics.inc('bot_messages_total', type='invalid')
             send_telegram_message(user_id, error_msg, parse_mode=None)
             return
-        
-        file_path = await message.download_media(file=f"/tmp/temp_photo_{message_id}.jpg")
-        
-        drive_file_url = ""
-        if file_path and os.path.exists(file_path):
-            file_size = os.path.getsize(file_path)
-            log_info(f"   [INFO] Фото скачано, размер: {file_size} байт")
-            
-            with open(file_path, 'rb') as f:
-                photo_data = f.read()
-            
-            drive_file_url = upload_photo_to_drive(photo_data, message_id)
-            os.remove(file_path)
-            log_info(f"   [OK] Временный файл удален")
-        else:
-            log_error("Не удалось скачать фото")
-        
-        district = extract_district(address)
-        is_duplicate = check_for_duplicate(sheets, tt, address)
-        
-        # Проверяем наличие адреса в МКД и обновляем статус
-        mkd_found, mkd_address = check_and_mark_address_in_mkd(sheets, address)
-        
-        current_date = get_moscow_date_str()
-        current_time = get_moscow_time_str()
-        
-        row_data = [''] * 19  # Увеличиваем до 19 колонок (A-S)
-        row_data[COL['DATE_OPENED']-1] = current_date
-        row_data[COL['TIME_OPENED']-1] = current_time
-        row_data[COL['TT']-1] = tt
-        row_data[COL['DISTRICT']-1] = district
-        row_data[COL['ADDRESS']-1] = address
-        row_data[COL['CHAT_ID']-1] = str(chat_id)
-        row_data[COL['MESSAGE_ID']-1] = str(message_id)
-        row_data[COL['PHOTO_URL']-1] = drive_file_url
-        row_data[COL['USER_ID']-1] = str(user_id)
-        
-        if is_duplicate:
-            row_data[COL['STATUS']-1] = "Возврат"
-            row_data[COL['ORIGINAL_STATUS']-1] = "Возврат"
-        
-        write_to_google_sheets(sheets, row_data, is_duplicate, mkd_found)
-        send_confirmation(user_id, tt, address, district, drive_file_url, is_duplicate, chat_title, mkd_found, mkd_address)
+        metrics.inc('bot_messages_total', type='photo' if message.photo else 'text')
     
+    if message.photo:
+        live_messages[(chat_id, message.id)] = message
+    if ingest_queue.enqueue(chat_id, message.id, user_id, chat_title, caption, bool(message.photo),
+                            group_id=group_id, delay=ALBUM_GROUP_WINDOW if group_id else 0):
+        log_info(f"[QUEUE] Заявка в очереди (ожидают: {ingest_queue.depth()})")
     else:
-        log_info("[INFO] Другой тип сообщения")
+        log_info(f"[QUEUE] Сообщение {message.id} уже в очереди, пропускаю")
+
+# ============ ДОГРУЗКА ПРОПУЩЕННЫХ СООБЩЕНИЙ ============
+class BackfillEvent:
+    """Событие для message_handler из сообщения, пришедшего, пока бот был остановлен"""
+    
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat_id
+    
+    async def get_sender(self):
+        return await self.message.get_sender()
+    
+    async def get_chat(self):
+        return await self.message.get_chat()
+
+def backfill_known_last_id(chat_id, last_message_ids):
+    """
+    Наибольший message_id, который уже существует и до которого пропуск проходится
+    без остановки на пустых пачках. В супергруппах счетчик id у каждого чата свой,
+    а в обычных группах общий для всех чатов бота, поэтому годится id из любой из них.
+    """
+    def shared(other_id):
+        return utils.resolve_id(other_id)[1] is not types.PeerChannel
+    
+    if not shared(chat_id):
+        return live_message_ids.get(chat_id)
+    known_ids = [message_id for other_id, message_id in (*last_message_ids.items(), *live_message_ids.items())
+                 if message_id is not None and shared(other_id)]
+    return max(known_ids, default=None)
+
+async def backfill_chat(client, chat_id, last_message_ids):
+    """
+    Проходит пропуск после last_message_ids[chat_id] (последнее сообщение чата, обработанное
+    до остановки) пачками по message_id - боту недоступна история чата, но доступны
+    сообщения по id - и передает их в обычный обработчик. Пустые пачки до известного
+    последнего id (backfill_known_last_id) пропуск не заканчивают. Возвращает число найденных сообщений.
+    """
+    last_message_id = last_message_ids.get(chat_id)
+    if last_message_id is None:
+        # Первый запуск с этой базой: пропуска еще нет
+        return 0
+    
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    
+    async def handle(message):
+        async with semaphore:
+            try:
+                await message_handler(BackfillEvent(message))
+            except Exception as e:
+                log_error(f"[BACKFILL] Ошибка обработки сообщения {message.id} из чата {chat_id}: {e}")
+    
+    found = 0
+    empty_batches = 0
+    next_id = last_message_id + 1
+    while next_id <= last_message_id + BACKFILL_MAX_MESSAGES:
+        # Граница пересчитывается: живые события во время догрузки ее сдвигают
+        known_last_id = backfill_known_last_id(chat_id, last_message_ids) or 0
+        if empty_batches >= BACKFILL_EMPTY_BATCHES and next_id > known_last_id:
+            log_info(f"[BACKFILL] Чат {chat_id}: {empty_batches} пустых пачки подряд после id {next_id - 1}, "
+                     f"известный последний id {known_last_id or 'нет'}, догрузка остановлена")
+            return found
+        ids = list(range(next_id, next_id + BACKFILL_BATCH_SIZE))
+        next_id += BACKFILL_BATCH_SIZE
+        messages = [message async for message in client.iter_messages(chat_id, ids=ids) if message is not None]
+        if not messages:
+            if ids[-1] >= known_last_id:
+                empty_batches += 1
+            continue
+        empty_batches = 0
+        found += len(messages)
+        # Служебные сообщения (вход в чат и т.п.) не заявки
+        await asyncio.gather(*(handle(message) for message in messages if not getattr(message, 'action', None)))
+    log_error(f"[BACKFILL] Чат {chat_id}: пропуск длиннее BACKFILL_MAX_MESSAGES={BACKFILL_MAX_MESSAGES} "
+              f"(id {last_message_id + 1}-{next_id - 1}), остальные сообщения не догружены")
+    return found
+
+async def backfill_missed_messages(client, chat_ids, last_message_ids):
+    """
+    Догружает пропущенные сообщения всех чатов; живые события при этом уже обрабатываются.
+    last_message_ids снимаются до подключения, пока живые события не сдвинули отметки.
+    """
+    started = time.perf_counter()
+    results = await asyncio.gather(
+        *(backfill_chat(client, chat_id, last_message_ids) for chat_id in chat_ids),
+        return_exceptions=True
+    )
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, BaseException):
+            log_error(f"[BACKFILL] Не удалось догрузить сообщения чата {chat_id}: {result}")
+        elif result:
+            log_info(f"[BACKFILL] Чат {chat_id}: догружено сообщений: {result}")
+    log_info(f"[BACKFILL] Догрузка завершена за {time.perf_counter() - started:.1f} с")
+
+# ============ НЕСКОЛЬКО ПРОЦЕССОВ: ЗАПИСЬ В ЛИСТ И ВОРКЕРЫ ============
+class WriterClient:
+    """
+    Клиент процесса записи для воркера (BOT_ROLE=worker): JSON-запросы по unix-сокету
+    WRITER_SOCKET через одну aiohttp-сессию. Ошибки связи поднимаются как исключения,
+    и заявка повторяется из очереди, как при ошибке Google API.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.session = None
+    
+    async def start(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.UnixConnector(path=self.path),
+                timeout=aiohttp.ClientTimeout(total=WRITER_TIMEOUT)
+            )
+    
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+    
+    async def call(self, method, **params):
+        async with self.session.post(f"http://writer/{method}", json=params) as response:
+            response.raise_for_status()
+            return await response.json()
+    
+    async def wait_ready(self, timeout=WRITER_STARTUP_TIMEOUT):
+        """Ждет, пока процесс записи загрузит индексы и откроет сокет"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                async with self.session.get("http://writer/ping") as response:
+                    if response.status == 200:
+                        return True
+            except (aiohttp.ClientError, OSError):
+                pass
+            if time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(1)
+    
+    async def is_processed(self, chat_id, message_id):
+        """Записана ли строка этого сообщения (индекс процесса записи засеян из листа)"""
+        try:
+            result = await self.call('processed', chat_id=chat_id, message_id=message_id)
+        except Exception as e:
+            log_warn(f"[WRITER] Не удалось проверить сообщение ({chat_id}, {message_id}): {e}")
+            return False
+        if result['processed']:
+            processed_messages.add(chat_id, [message_id])
+        return result['processed']
+    
+    async def prefetch_drive_folder(self):
+        """Папку дня создает процесс записи, чтобы воркеры не создали по своей"""
+        folder_name = get_moscow_time().strftime("%d-%m-%Y")
+        if folder_name in drive_folder_cache:
+            return
+        result = await self.call('drive_folder', name=folder_name)
+        drive_folder_cache.clear()
+        drive_folder_cache[folder_name] = result['folder_id']
+    
+    async def write_ticket(self, chat_id, message_id, user_id, tt, address, district, state, save_state=None):
+        """
+        Проверка дубликата, поиск в МКД и запись строки в процессе записи.
+        Результаты проверок сохраняются в state и при повторе не выполняются заново.
+        """
+        result = await self.call(
+            'ticket', chat_id=chat_id, message_id=message_id, user_id=user_id, tt=tt, address=address,
+            district=district, photo_link=state['photo_link'],
+            is_duplicate=state.get('is_duplicate'), mkd=state.get('mkd')
+        )
+        if result.get('already_written'):
+            raise TicketAlreadyWritten(result['row_number'])
+        state['is_duplicate'] = result['is_duplicate']
+        state['mkd'] = result['mkd']
+        if save_state:
+            save_state()
+        return result['row_number']
+    
+    async def photo_link(self, photo_hash):
+        """Ссылка на фото с таким хэшем из общего индекса процесса записи (или None)"""
+        try:
+            result = await self.call('photo_link', hash=photo_hash)
+        except Exception as e:
+            log_warn(f"[WRITER] Не удалось проверить хэш фото: {e}")
+            return None
+        return result['link']
+    
+    async def save_photo_link(self, photo_hash, link):
+        try:
+            await self.call('photo_saved', hash=photo_hash, link=link)
+        except Exception as e:
+            log_warn(f"[WRITER] Не удалось сохранить хэш фото: {e}")
+
+async def handle_writer_ping(request):
+    return web.json_response({'ok': True})
+
+async def handle_writer_ticket(request):
+    body = await request.json()
+    key = processed_messages.make_key(body['chat_id'], body['message_id'])
+    # Воркер повторяет заявку, если не дождался ответа: строка могла уже записаться
+    # или еще записываться. is_processed воркера при ошибке связи отвечает "нет"
+    in_flight = writer_tickets_in_flight.get(key)
+    if in_flight is not None:
+        row_number = await asyncio.shield(in_flight)
+        if row_number is None:
+            raise web.HTTPServiceUnavailable(text="Строка не записана")
+        return web.json_response({'row_number': row_number, 'already_written': True})
+    if key in processed_messages:
+        return web.json_response({'row_number': processed_messages.row_number(key), 'already_written': True})
+    
+    future = asyncio.get_running_loop().create_future()
+    writer_tickets_in_flight[key] = future
+    row_number = None
+    tt, address = body['tt'], body['address']
+    is_duplicate = body.get('is_duplicate')
+    reserved = is_duplicate is None
+    if reserved:
+        is_duplicate = check_for_duplicate(tt, address)
+    try:
+        mkd = body.get('mkd')
+        if mkd is None:
+            mkd = check_and_mark_address_in_mkd(address)
+        row_data = build_ticket_row(body['chat_id'], body['message_id'], body['user_id'], tt, address,
+                                    body['district'], body['photo_link'], is_duplicate)
+        row_number = await sheet_writer.write(row_data, is_duplicate, mkd[0])
+    finally:
+        if reserved:
+            duplicate_index.release(tt, address)
+        del writer_tickets_in_flight[key]
+        future.set_result(row_number)
+    return web.json_response({'row_number': row_number, 'is_duplicate': is_duplicate, 'mkd': list(mkd)})
+
+async def handle_writer_photo_link(request):
+    body = await request.json()
+    return web.json_response({'link': photo_hashes.get(body['hash'])})
+
+async def handle_writer_photo_saved(request):
+    body = await request.json()
+    await run_blocking(photo_hashes.add, body['hash'], body['link'], executor=local_executor)
+    return web.json_response({'ok': True})
+
+async def handle_writer_processed(request):
+    body = await request.json()
+    key = processed_messages.make_key(body['chat_id'], body['message_id'])
+    return web.json_response({'processed': key in processed_messages})
+
+async def handle_writer_drive_folder(request):
+    body = await request.json()
+    drive = get_drive_service()
+    if not drive:
+        raise web.HTTPServiceUnavailable(text="Нет подключения к Google Drive")
+    folder_id = await run_blocking(get_daily_drive_folder, drive, body['name'])
+    return web.json_response({'folder_id': folder_id})
+
+async def start_writer_server():
+    """Unix-сокет процесса записи для воркеров"""
+    app = web.Application()
+    app.router.add_get('/ping', handle_writer_ping)
+    app.router.add_post('/ticket', handle_writer_ticket)
+    app.router.add_post('/processed', handle_writer_processed)
+    app.router.add_post('/drive_folder', handle_writer_drive_folder)
+    app.router.add_post('/photo_link', handle_writer_photo_link)
+    app.router.add_post('/photo_saved', handle_writer_photo_saved)
+    
+    directory = os.path.dirname(WRITER_SOCKET)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # Сокет от прошлого запуска мешает bind
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(WRITER_SOCKET)
+    # Без access-лога: по строке на каждую заявку
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.UnixSite(runner, WRITER_SOCKET).start()
+    log_info(f"[WRITER] Принимаю заявки воркеров на {WRITER_SOCKET}")
+    return runner
+
+def wait_for_stop_signal():
+    """Event, который установят SIGTERM/SIGINT"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def writer_main():
+    """
+    BOT_ROLE=writer: единственный процесс, который пишет строки в лист. Держит пакетную
+    запись, индексы дубликатов и записанных сообщений, кэш и отметки МКД, копию листа для /tickets.
+    """
+    startup = StartupTimer(PROCESS_STARTED)
+    log_info("=" * 70)
+    log_info(f"Telegram Monitor Bot v3.7.0-Render: процесс записи (воркеров: {BOT_PROCESSES})")
+    log_info("=" * 70)
+    stop = wait_for_stop_signal()
+    
+    async with startup.phase("веб-сервер и база состояния"):
+        await start_web_server()
+        ingest_queue.open()
+        processed_messages.attach(ingest_queue)
+        photo_hashes.attach(ingest_queue)
+        mkd_status_writer.attach(ingest_queue)
+        ticket_mirror.open()
+    
+    runner = None
+    try:
+        if not await warm_up_google(startup):
+            log_error("Ошибка подключения к Google Sheets")
+            return
+        start_background_task(duplicate_reconcile_loop())
+        start_background_task(mkd_refresh_loop())
+        start_background_task(mkd_status_writer.run())
+        start_background_task(sheet_format_queue.run())
+        start_background_task(ticket_mirror_sync_loop())
+        start_background_task(ingest_maintenance_loop())
+        # Сокет открывается после загрузки индексов: до этого воркеры ждут
+        runner = await start_writer_server()
+        startup.total()
+        await stop.wait()
+        log_info("[STOP] Остановлено")
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await sheet_writer.close()
+        await sheet_format_queue.close()
+        await mkd_status_writer.close()
+        log_info(f"[INFO] Google API: {get_google_client_stats_str()}")
+
+async def run_child_process(name, env, stop):
+    """Держит процесс запущенным: перезапуск с нарастающей паузой, пока не пришел stop"""
+    delay = 1
+    while not stop.is_set():
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        log_info(f"[SUPERVISOR] {name}: запущен (pid {process.pid})")
+        wait_task = asyncio.create_task(process.wait())
+        stop_task = asyncio.create_task(stop.wait())
+        await asyncio.wait({wait_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        stop_task.cancel()
+        if stop.is_set():
+            if process.returncode is None:
+                # SIGINT - как Ctrl+C: процесс дописывает буферы и закрывает соединения
+                process.send_signal(signal.SIGINT)
+                try:
+                    await asyncio.wait_for(wait_task, SUPERVISOR_STOP_TIMEOUT)
+                except asyncio.TimeoutError:
+                    log_warn(f"[SUPERVISOR] {name}: не остановился за {SUPERVISOR_STOP_TIMEOUT} с, завершаю")
+                    process.kill()
+                    await wait_task
+            log_info(f"[SUPERVISOR] {name}: остановлен")
+            return
+        if time.monotonic() - started > SUPERVISOR_RESTART_MAX_DELAY:
+            delay = 1
+        log_warn(f"[SUPERVISOR] {name}: завершился с кодом {process.returncode}, перезапуск через {delay} с")
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+        delay = min(delay * 2, SUPERVISOR_RESTART_MAX_DELAY)
+
+async def supervise():
+    """
+    BOT_PROCESSES > 0: запускает этим же файлом процесс записи и воркеры. У каждого воркера
+    свои чаты, сессия Telethon, база состояния и порт /ping (PORT + 1 + номер),
+    квота Drive делится поровну между всеми процессами.
+    """
+    log_info("=" * 70)
+    log_info(f"Telegram Monitor Bot v3.7.0-Render: {BOT_PROCESSES} воркеров и процесс записи")
+    log_info("=" * 70)
+    stop = wait_for_stop_signal()
+    
+    port = int(os.environ.get('PORT', 10000))
+    state_base, state_ext = os.path.splitext(STATE_DB_PATH)
+    drive_quota = max(1, GOOGLE_QUOTA_PER_MINUTE['drive'] // (BOT_PROCESSES + 1))
+    children = {'writer': {'BOT_ROLE': 'writer', 'PORT': str(port)}}
+    for shard in range(BOT_PROCESSES):
+        name = f"worker{shard}"
+        chat_ids = shard_chat_ids(CHAT_IDS, shard, BOT_PROCESSES)
+        if not chat_ids:
+            log_warn(f"[SUPERVISOR] {name}: нет чатов (chat_id % {BOT_PROCESSES} == {shard}), не запускается")
+            continue
+        log_info(f"[SUPERVISOR] {name}: чаты {', '.join(map(str, chat_ids))}")
+        children[name] = {
+            'BOT_ROLE': 'worker',
+            'BOT_SHARD': str(shard),
+            'PORT': str(port + 1 + shard),
+            'STATE_DB_PATH': f"{state_base}_{name}{state_ext}",
+            'TELEGRAM_SESSION': f"{TELEGRAM_SESSION}_{name}",
+        }
+    
+    tasks = []
+    for name, overrides in children.items():
+        env = dict(os.environ, BOT_PROCESS_NAME=name, WRITER_SOCKET=WRITER_SOCKET,
+                   DRIVE_REQUESTS_PER_MINUTE=str(drive_quota), **overrides)
+        tasks.append(run_child_process(name, env, stop))
+    await asyncio.gather(*tasks)
+    log_info("[OK] Все процессы остановлены")
+
+# ============ ЗАПУСК ============
+class StartupTimer:
+    """Длительность фаз запуска (фазы могут идти параллельно) для лога"""
+    
+    def __init__(self, started):
+        self.started = started
+    
+    def mark(self, name, seconds):
+        log_info(f"[START] {name}: {seconds * 1000:.0f} мс")
+    
+    @contextlib.asynccontextmanager
+    async def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.mark(name, time.perf_counter() - started)
+    
+    def total(self):
+        self.mark("готов к обработке (с запуска процесса)", time.perf_counter() - self.started)
+
+async def warm_up_google(startup):
+    """Клиенты Google и данные листов; загрузки листов идут параллельно"""
+    async with startup.phase("клиенты Google API"):
+        if not await run_blocking(init_google_clients):
+            return False
+    sheets = sheets_service
+    
+    async def load(name, func):
+        async with startup.phase(name):
+            await run_blocking(func, sheets)
+    
+    async def load_duplicates():
+        # Без индекса каждый "Возврат" записался бы как новая заявка, поэтому
+        # воркеры не стартуют, пока он не загружен (заявки тем временем копятся в очереди)
+        delay = 1
+        async with startup.phase("индекс дубликатов"):
+            while not await run_blocking(load_duplicate_index, sheets):
+                log_warn(f"[DUP] Повтор загрузки индекса дубликатов через {delay} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, DUPLICATE_LOAD_RETRY_MAX_DELAY)
+    
+    await asyncio.gather(
+        load("заголовки листа", add_headers_if_needed),
+        load_duplicates(),
+        # Адреса из МКД сразу в кэш (если лист существует)
+        load("лист МКД", load_mkd_addresses_with_rows)
+    )
+    log_info("[OK] Подключение к Google Sheets")
+    return True
+
+async def warm_up_worker(startup):
+    """Воркер: клиенты Google (только Drive) и готовность процесса записи"""
+    async with startup.phase("клиенты Google API"):
+        if not await run_blocking(init_google_clients):
+            return False
+    async with startup.phase("процесс записи"):
+        await writer_client.start()
+        if not await writer_client.wait_ready():
+            log_error(f"Процесс записи не ответил на {WRITER_SOCKET}")
+            return False
+    log_info("[OK] Подключение к процессу записи")
+    return True
+
+async def resolve_chats(client, startup):
+    """Проверяет доступ ко всем чатам одновременно, возвращает доступные"""
+    async def resolve(chat_id):
+        try:
+            chat = await client.get_entity(chat_id)
+            log_info(f"[OK] Подключено к чату: {getattr(chat, 'title', chat_id)}")
+            return chat_id
+        except Exception as e:
+            log_error(f"Нет доступа к чату {chat_id}: {e}")
+            return None
+    
+    async with startup.phase("чаты Telegram"):
+        results = await asyncio.gather(*(resolve(chat_id) for chat_id in CHAT_IDS))
+    return [chat_id for chat_id in results if chat_id is not None]
 
 # ============ ОСНОВНАЯ ФУНКЦИЯ ============
 async def main():
+    global bot_client, writer_client
+    
+    startup = StartupTimer(PROCESS_STARTED)
+    startup.mark("импорт модулей и настройка", time.perf_counter() - PROCESS_STARTED)
+    
     log_info("=" * 70)
     log_info("Telegram Monitor Bot v3.7.0-Render")
+    if BOT_ROLE == 'worker':
+        log_info(f"[INFO] Воркер {BOT_SHARD + 1} из {BOT_PROCESSES}, запись в лист через {WRITER_SOCKET}")
     log_info("=" * 70)
     log_info(f"[INFO] Google таблица: {SPREADSHEET_ID}")
     log_info(f"[INFO] Лист ТТ: {SHEET_NAME}")
@@ -816,42 +3632,68 @@ async def main():
         log_info(f"   {i}. ID: {chat_id}")
     log_info("=" * 70)
     
-    await start_web_server()
+    async with startup.phase("веб-сервер и очереди"):
+        await start_web_server()
+        await telegram_sender.start()
+        ingest_queue.open()
+        processed_messages.attach(ingest_queue)
+        photo_hashes.attach(ingest_queue)
+        if BOT_ROLE != 'worker':
+            mkd_status_writer.attach(ingest_queue)
+            ticket_mirror.open()
+        last_message_ids = {chat_id: ingest_queue.last_message_id(chat_id) for chat_id in CHAT_IDS}
     
-    client = TelegramClient('bot_session', API_ID, API_HASH)
+    # Google прогревается параллельно с подключением к Telegram
+    if BOT_ROLE == 'worker':
+        writer_client = WriterClient(WRITER_SOCKET)
+        google_task = asyncio.create_task(warm_up_worker(startup))
+    else:
+        google_task = asyncio.create_task(warm_up_google(startup))
+    
+    client = TelegramClient(TELEGRAM_SESSION, API_ID, API_HASH)
+    bot_client = client
+    # Render останавливает процесс по SIGTERM: отключаемся от Telegram,
+    # чтобы finally дописал пакет строк и отметки МКД (на Windows обработчиков сигналов нет)
+    with contextlib.suppress(NotImplementedError):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, lambda: start_background_task(client.disconnect())
+        )
+    
+    # Обработчик регистрируется до подключения: сообщения, пришедшие во время прогрева,
+    # сразу сохраняются в очередь и обрабатываются, как только запустятся воркеры
+    @client.on(events.NewMessage(chats=CHAT_IDS))
+    async def handler(event):
+        live_message_ids[event.chat_id] = max(event.message.id, live_message_ids.get(event.chat_id, 0))
+        await message_handler(event)
     
     try:
-        await client.start(bot_token=BOT_TOKEN)
+        async with startup.phase("подключение к Telegram"):
+            await client.start(bot_token=BOT_TOKEN)
         log_info("[OK] Бот подключился к Telegram")
         
-        sheets = init_google_sheets()
-        if sheets:
-            add_headers_if_needed(sheets)
-            # Предварительно загружаем адреса из МКД в кэш (если лист существует)
-            load_mkd_addresses_with_rows(sheets)
-            log_info("[OK] Подключение к Google Sheets")
-        else:
+        successful_chats = await resolve_chats(client, startup)
+        # Пропущенные за время простоя сообщения встают в ту же очередь, что и живые
+        start_background_task(backfill_missed_messages(client, successful_chats, last_message_ids))
+        
+        if not await google_task:
             log_error("Ошибка подключения к Google Sheets")
             return
         
-        successful_chats = []
-        for chat_id in CHAT_IDS:
-            try:
-                chat = await client.get_entity(chat_id)
-                log_info(f"[OK] Подключено к чату: {getattr(chat, 'title', chat_id)}")
-                successful_chats.append(chat_id)
-            except Exception as e:
-                log_error(f"Нет доступа к чату {chat_id}: {e}")
-        
         if not successful_chats:
             log_error("Нет доступных чатов")
             return
         
-        @client.on(events.NewMessage(chats=successful_chats))
-        async def handler(event):
-            await message_handler(event)
+        if writer_client is None:
+            start_background_task(duplicate_reconcile_loop())
+            start_background_task(mkd_refresh_loop())
+            start_background_task(mkd_status_writer.run())
+            start_background_task(sheet_format_queue.run())
+            start_background_task(ticket_mirror_sync_loop())
+        start_ingest_workers()
+        startup.total()
         
         log_info(f"\n[OK] Мониторинг {len(successful_chats)} чатов")
+        log_info(f"[INFO] Воркеров очереди: {INGEST_WORKERS}, потоков Google API: {GOOGLE_IO_WORKERS}, отправителей Bot API: {BOT_API_WORKERS}")
         log_info("[INFO] Ctrl+C для остановки")
         log_info("-" * 70)
         
@@ -863,12 +3705,22 @@ async def main():
         log_error(f"{e}")
         traceback.print_exc()
     finally:
+        if not google_task.done():
+            google_task.cancel()
+        await sheet_writer.close()
+        await sheet_format_queue.close()
+        await mkd_status_writer.close()
+        await telegram_sender.close()
+        if writer_client is not None:
+            await writer_client.close()
         await client.disconnect()
+        log_info(f"[INFO] Google API: {get_google_client_stats_str()}")
         log_info("[OK] Отключено")
 
 # ============ ТОЧКА ВХОДА ============
 if __name__ == '__main__':
+    entry_points = {'supervisor': supervise, 'writer': writer_main}
     try:
-        asyncio.run(main())
+        asyncio.run(entry_points.get(BOT_ROLE, main)())
     except KeyboardInterrupt:
         log_info("\n[STOP] Приложение остановлено")